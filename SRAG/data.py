@@ -1,208 +1,615 @@
-""" This file is used to clean the data from the csv file and generate a processed csv file"""""
+""" This file is used to clean the data from the csv file and generate a processed parquet cache"""""
+import hashlib
+import json
 import os
+import shutil
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
 
 from pretrainingbias.pre_training_bias import PreTrainingBias
 
+DATASET_DIR = "resources/datasets"
+COLUMNS_FILE = "resources/datasets/columns.txt"
+DATASETS = {
+    '2021': 'INFLUD21-01-05-2023',
+    '2022': 'INFLUD22-03-04-2023',
+    '2023': 'INFLUD23-16-10-2023',
+}
+# rows read from the raw file at a time, bounds the memory used while processing it
+CHUNK_SIZE = 200_000
+STRING_COLUMNS = ['DT_SIN_PRI', 'SG_UF_NOT', 'ID_MUNICIP', 'CS_SEXO', 'DT_NASC', 'SG_UF', 'SG_UF_INTE']
+# the processed cache is a directory with a parquet file per epidemiological week, the key, ID, week and
+# removal rule of every raw row and a manifest with the fingerprints, the cleaning report and the number
+# of cases per state and week
+WEEKS_DIR = 'weeks'
+KEYS_FILE = 'keys.parquet'
+MANIFEST_FILE = 'manifest.json'
+# rows are matched across republished raw files by notification number and epidemiological week. ROW_KEY
+# hashes both with the occurrence of the pair, so duplicated notifications still get distinct keys
+ROW_KEY = 'ROW_KEY'
+KEY_COLUMNS = ['NU_NOTIFIC', 'SEM_PRI']
+
+# code used by SRAG for ignored answers, missing values are treated the same way
+MISSING_CODE = 9
+# rows missing any of these columns are removed
+REQUIRED_COLUMNS = ['UTI', 'CS_RACA', 'CS_SEXO', 'VACINA_COV']
+# rule name -> (column, values that remove the row)
+CLEANING_RULES = {
+    'UTI ignored': ('UTI', [MISSING_CODE]),
+    'CS_SEXO ignored': ('CS_SEXO', ['I']),
+    'CS_RACA ignored': ('CS_RACA', [MISSING_CODE]),
+    'DT_NASC missing': ('DT_NASC', [MISSING_CODE]),
+    'DT_SIN_PRI missing': ('DT_SIN_PRI', [MISSING_CODE]),
+    'VACINA_COV ignored': ('VACINA_COV', [MISSING_CODE]),
+}
+# reasons a row is removed for, in the order they are checked, a row is reported by the first one
+REMOVAL_RULES = ['required column missing', *CLEANING_RULES]
+DATE_COLUMNS = ['DT_SIN_PRI', 'DT_NASC']
+CODE_MAPS = {
+    'CS_SEXO': {'F': 0, 'M': 1},
+    'UTI': {1: 1, 2: 0},
+    'VACINA_COV': {1: 1, 2: 0},
+}
+
+# small coded answers (1 = yes, 2 = no, 9 = ignored and similar)
+CODE_COLUMNS = ['SEM_PRI', 'CS_SEXO', 'CS_GESTANT', 'CS_RACA', 'CS_ESCOL_N', 'FEBRE', 'TOSSE',
+                'GARGANTA', 'DISPNEIA', 'DESC_RESP', 'SATURACAO', 'DIARREIA', 'VOMITO', 'DOR_ABD',
+                'FADIGA', 'PERD_OLFT', 'PERD_PALA', 'FATOR_RISC', 'PUERPERA', 'CARDIOPATI',
+                'HEMATOLOGI', 'SIND_DOWN', 'HEPATICA', 'ASMA', 'DIABETES', 'NEUROLOGIC', 'PNEUMOPATI',
+                'IMUNODEPRE', 'RENAL', 'OBESIDADE', 'VACINA_COV', 'HOSPITAL', 'UTI', 'SUPORT_VEN',
+                'TOMO_RES', 'CLASSI_FIN']
+# compact types of the processed SRAG frame, dates are stored as days since 1970-01-01
+SRAG_SCHEMA = {
+    'ID': 'int32',
+    'DT_SIN_PRI': 'int32',
+    'DT_NASC': 'int32',
+    'CO_MUN_NOT': 'int32',
+    'SG_UF_NOT': 'category',
+    'ID_MUNICIP': 'category',
+    'SG_UF': 'category',
+    'SG_UF_INTE': 'category',
+    **{column: 'int8' for column in CODE_COLUMNS},
+}
+ARROW_TYPES = {'int8': pa.int8(), 'int32': pa.int32(), 'category': pa.string()}
+SECONDS_PER_DAY = 86400
+
+REGIONS = {
+    'sul': ['PR', 'SC', 'RS'],
+    'sudeste': ['SP', 'RJ', 'MG', 'ES'],
+    'centro_oeste': ['MS', 'MT', 'GO', 'DF'],
+    'nordeste': ['MA', 'PI', 'CE', 'RN', 'PE', 'PB', 'SE', 'AL', 'BA'],
+    'norte': ['AC', 'AP', 'AM', 'PA', 'RO', 'RR', 'TO']
+}
+STATE_REGIONS = {state: region for region, states in REGIONS.items() for state in states}
+COUNTRY = 'BR'
+# columns identifying the finest geographic level, municipality names are only unique within a state
+MUNICIPALITY_KEY = ['SG_UF_NOT', 'ID_MUNICIP']
+# geographic levels from the finest to the coarsest: level -> parent of each group of the level before it.
+# Bias counts are built once by MUNICIPALITY_KEY and summed upward, groups without parent are dropped
+GEOGRAPHIC_HIERARCHY = {
+    'municipality': None,
+    'state': lambda municipality: municipality[0],
+    'region': STATE_REGIONS.get,
+    'country': lambda region: COUNTRY,
+}
+
+
+def apply_schema(df: pd.DataFrame) -> pd.DataFrame:
+    """ Casts the columns of df to the compact types declared in SRAG_SCHEMA"""
+    dtypes = {column: dtype for column, dtype in SRAG_SCHEMA.items() if column in df.columns}
+    for column, dtype in dtypes.items():
+        if dtype != 'category':
+            continue
+        if isinstance(df[column].dtype, pd.CategoricalDtype):
+            # parquet dictionaries come in order of appearance, keep categories sorted like astype does
+            df[column] = df[column].cat.reorder_categories(sorted(df[column].cat.categories))
+        else:
+            # the fill value 9 is mixed with the strings, keep a single category type
+            df[column] = df[column].astype(str)
+    return df.astype(dtypes)
+
+def pair_keys(df: pd.DataFrame) -> np.ndarray:
+    """ Hashes the KEY_COLUMNS of raw rows to uint64. The notification number is read as a string
+    and the week is hashed as a number, so both match however the rest of the row is parsed"""
+    keys = df[[column for column in KEY_COLUMNS if column in df.columns]].fillna({'NU_NOTIFIC': ''})
+    keys['SEM_PRI'] = pd.to_numeric(keys['SEM_PRI'], errors='coerce').astype(float)
+    return pd.util.hash_pandas_object(keys, index=False).values
+
+def row_keys(pairs: np.ndarray) -> np.ndarray:
+    """ Returns the ROW_KEY of rows from the hashes of their KEY_COLUMNS, numbering repeated pairs
+    in order of appearance"""
+    occurrence = pd.Series(pairs).groupby(pairs).cumcount().values
+    return pd.util.hash_pandas_object(pd.DataFrame({'pair': pairs, 'occurrence': occurrence}), index=False).values
+
+def removal_rules(df: pd.DataFrame) -> np.ndarray:
+    """ Returns for each raw row 0 when it is kept, otherwise the position + 1 in REMOVAL_RULES
+    of the first rule that removes it"""
+    rules = df[REQUIRED_COLUMNS].isna().any(axis=1).values.astype(np.int8)
+    for position, (column, values) in enumerate(CLEANING_RULES.values(), start=2):
+        matches = df[column].isin(values).values
+        if MISSING_CODE in values:
+            matches |= df[column].isna().values
+        rules[(rules == 0) & matches] = position
+    return rules
+
+def report_from_rules(rules) -> dict:
+    """ Returns the number of rows read, removed by each rule and kept, from the removal rule of each row"""
+    counts = np.bincount(rules, minlength=len(REMOVAL_RULES) + 1)
+    report = {'rows read': int(counts.sum())}
+    report.update({rule: int(count) for rule, count in zip(REMOVAL_RULES, counts[1:])})
+    report['rows kept'] = int(counts[0])
+    return report
+
+def split_weeks(table: pa.Table):
+    """ Yields the (week, rows) of a table sorted by SEM_PRI"""
+    weeks = table['SEM_PRI'].to_numpy()
+    starts = np.flatnonzero(np.diff(weeks, prepend=-1))
+    for start, end in zip(starts, np.append(starts[1:], len(weeks))):
+        yield int(weeks[start]), table.slice(start, end - start)
+
 class DataReader:
-    """ Class to read the data from the csv file and generate a processed csv file"""
+    """ Class to read the data from the csv file and generate a processed parquet cache"""
     year = ""
     df = None
+    partitions = None
+    delta = None
+    geographic = None
 
-    def __init__(self, year):
-        """ Initialize the data reader"""
+    def __init__(self, year, columns=None, load=True):
+        """ Initialize the data reader. If columns is given, only those columns are loaded from the cache.
+        Without load only the file names are set, e.g. to fingerprint the data without reading it"""
         self.year = year
-        if year == '2021':
-            self.csv_file = "resources/datasets/INFLUD21-01-05-2023.csv"
-            self.target_csv_file = "resources/datasets/PROCESSED_INFLUD21-01-05-2023.csv"
-            self.df = self.pre_process_srag()
-        elif year == '2022':
-            self.csv_file = "resources/datasets/INFLUD22-03-04-2023.csv"
-            self.target_csv_file = "resources/datasets/PROCESSED_INFLUD22-03-04-2023.csv"
-            self.df = self.pre_process_srag()
-        elif year == '2023':
-            self.csv_file = "resources/datasets/INFLUD23-16-10-2023.csv"
-            self.target_csv_file = "resources/datasets/PROCESSED_INFLUD23-16-10-2023.csv"
-            self.df = self.pre_process_srag()
+        self.columns = columns
+        self.geographic = {}
+        if year in DATASETS:
+            self.csv_file = f"{DATASET_DIR}/{DATASETS[year]}.csv"
+            self.target_csv_file = f"{DATASET_DIR}/PROCESSED_{DATASETS[year]}.csv"
+            self.cache_dir = f"{DATASET_DIR}/PROCESSED_{DATASETS[year]}"
+            if load:
+                self.df = self.pre_process_srag()
 
     def get_dataframe(self) -> pd.DataFrame:
         """ Returns the dataframe"""
         return self.df
 
+    def config_fingerprint(self) -> str:
+        """ Returns a fingerprint of the selected columns, cleaning rules and schema. A cache built
+        with the same configuration can be refreshed incrementally when the raw file changes"""
+        digest = hashlib.sha256()
+        with open(COLUMNS_FILE, 'rb') as f:
+            digest.update(f.read())
+        digest.update(repr((CLEANING_RULES, CODE_MAPS, SRAG_SCHEMA, KEY_COLUMNS)).encode())
+        return digest.hexdigest()
+
+    def source_fingerprint(self) -> str:
+        """ Returns a fingerprint of the raw INFLUD file and the configuration,
+        used to invalidate the processed cache"""
+        digest = hashlib.sha256()
+        stat = os.stat(self.csv_file)
+        digest.update(f"{stat.st_size}:{stat.st_mtime_ns}".encode())
+        digest.update(self.config_fingerprint().encode())
+        return digest.hexdigest()
+
+    def read_manifest(self) -> dict:
+        """ Returns the manifest of the cache, empty when there is no complete cache"""
+        manifest_file = f"{self.cache_dir}/{MANIFEST_FILE}"
+        if not os.path.isfile(manifest_file):
+            return {}
+        with open(manifest_file, 'r', encoding='utf-8') as f:
+            return json.load(f)
+
+    def is_cache_valid(self) -> bool:
+        """ Checks if the processed cache exists and was built from the current raw file, columns and schema"""
+        manifest = self.read_manifest()
+        if not manifest:
+            return False
+        if not os.path.isfile(self.csv_file):
+            # raw file is not available, nothing to compare against
+            return True
+        return manifest['fingerprint'] == self.source_fingerprint()
+
+    def cache_fingerprint(self) -> str:
+        """ Returns the source fingerprint the processed cache was built from"""
+        return self.read_manifest().get('fingerprint', '')
+
+    def fingerprint(self) -> str:
+        """ Returns the source fingerprint of the raw file, or the one of the cache when only the cache is available"""
+        return self.source_fingerprint() if os.path.isfile(self.csv_file) else self.cache_fingerprint()
+
+    def raw_header(self) -> list:
+        """ Returns the columns of the raw INFLUD file"""
+        return list(pd.read_csv(self.csv_file, sep=';', quotechar='"', encoding='utf-8', nrows=0).columns)
+
+    def can_refresh(self) -> bool:
+        """ Checks if the stale cache has row keys, was built with the current configuration
+        and the raw file has the key columns"""
+        if not os.path.isfile(f"{self.cache_dir}/{KEYS_FILE}") or not os.path.isfile(self.csv_file):
+            return False
+        return self.read_manifest().get('config') == self.config_fingerprint() and \
+            set(KEY_COLUMNS) <= set(self.raw_header())
+
+    def week_file(self, week, cache_dir=None) -> str:
+        """ Returns the parquet file with the rows of an epidemiological week"""
+        return f"{cache_dir or self.cache_dir}/{WEEKS_DIR}/SEM_PRI-{week:02d}.parquet"
+
+    def cache_schema(self) -> pa.Schema:
+        """ Returns the arrow schema shared by the week files"""
+        return pq.read_schema(f"{self.cache_dir}/{WEEKS_DIR}/{min(os.listdir(f'{self.cache_dir}/{WEEKS_DIR}'))}")
+
     def pre_process_srag(self):
         """ Preprocess the SRAG data """
-        if os.path.isfile(self.target_csv_file):
-            return pd.read_csv(self.target_csv_file)
+        if self.is_cache_valid():
+            return self.read_cache()
+
+        if not os.path.isfile(self.csv_file) and os.path.isfile(self.target_csv_file):
+            # convert the legacy csv cache, keeping its index as the row id
+            self.df = pd.read_csv(self.target_csv_file).rename(columns={'Unnamed: 0': 'ID'})
+            for column in DATE_COLUMNS:
+                self.df[column] = self.df[column] // SECONDS_PER_DAY
+            self.df = apply_schema(self.df)
+            self.write_cache(fingerprint="")
+            return self.df if self.columns is None else self.df[self.columns]
+
+        if self.can_refresh():
+            self.delta = self.refresh()
+        else:
+            self.ingest_raw_file()
+        return self.read_cache()
+
+    def read_cache(self) -> pd.DataFrame:
+        """ Reads the week files of the cache in ID order, decoding the categorical columns straight to categories"""
+        columns = self.columns or self.cache_schema().names
+        categories = [column for column in columns if SRAG_SCHEMA.get(column) == 'category']
+        df = pd.read_parquet(f"{self.cache_dir}/{WEEKS_DIR}", columns=list(dict.fromkeys(columns + ['ID'])),
+                             read_dictionary=categories)
+        df = df.sort_values('ID').reset_index(drop=True)
+        return apply_schema(df if 'ID' in columns else df.drop(columns='ID'))
 
-        with open("resources/datasets/columns.txt", 'r', encoding='utf-8') as f:
+    def raw_keys(self) -> np.ndarray:
+        """ Returns the ROW_KEY of every raw row, reading only the key columns of the raw file"""
+        reader = pd.read_csv(self.csv_file, sep=';', quotechar='"', encoding='utf-8', dtype={'NU_NOTIFIC': str},
+                             usecols=[column for column in KEY_COLUMNS if column in self.raw_header()],
+                             chunksize=CHUNK_SIZE)
+        return row_keys(np.concatenate([pair_keys(chunk) for chunk in reader]))
+
+    def read_raw_chunks(self, rows=None):
+        """ Streams the raw INFLUD file in chunks of the columns in columns.txt, indexed by the raw
+        row number, with the hashes of their KEY_COLUMNS. When rows (sorted raw row numbers) is given,
+        the other rows are skipped by the tokenizer without being converted"""
+        with open(COLUMNS_FILE, 'r', encoding='utf-8') as f:
             columns = [line.rstrip() for line in f]
 
-        df = pd.read_csv(self.csv_file, sep=';', quotechar='"', encoding='utf-8', low_memory=False)
-        self.df = df.filter(items=columns)
-        self.beautify_dataframe()
-        self.df.to_csv(self.target_csv_file)
-        return self.df
+        skiprows = None
+        if rows is not None:
+            if len(rows) == 0:
+                return
+            # line 0 is the header
+            wanted = np.zeros(rows[-1] + 2, dtype=bool)
+            wanted[0] = True
+            wanted[rows + 1] = True
+            skiprows = lambda line: line >= len(wanted) or not wanted[line]
+
+        reader = pd.read_csv(self.csv_file, sep=';', quotechar='"', encoding='utf-8',
+                             usecols=lambda column: column in columns or column in KEY_COLUMNS,
+                             dtype={column: str for column in STRING_COLUMNS + ['NU_NOTIFIC']},
+                             skiprows=skiprows, chunksize=CHUNK_SIZE)
+        for chunk in reader:
+            # the chunk index keeps counting the rows read across chunks
+            if rows is not None:
+                chunk.index = rows[chunk.index]
+            yield chunk[[column for column in chunk.columns if column in columns]], pair_keys(chunk)
+
+    def clean_chunk(self, chunk, rules, first_id=0) -> pd.DataFrame:
+        """ Cleans a raw chunk, storing the removal rule of each of its rows in rules (indexed by
+        raw row number - first_id). Kept rows get the ID first_id + raw row number"""
+        self.df = chunk.set_axis(chunk.index + first_id)
+        rules[chunk.index] = removal_rules(self.df)
+        self.beautify_dataframe(rules[chunk.index])
+        return apply_schema(self.df.reset_index(names='ID'))
+
+    def ingest_raw_file(self):
+        """ Streams the raw INFLUD file in chunks, cleaning each chunk and appending its rows to the
+        file of their epidemiological week. The new cache replaces the old one once complete"""
+        fingerprint = self.source_fingerprint()
+        build_dir = f"{self.cache_dir}.partial"
+        shutil.rmtree(build_dir, ignore_errors=True)
+        os.makedirs(f"{build_dir}/{WEEKS_DIR}")
+        writers, pairs, rules, weeks, counts, schema = {}, [], [], [], [], None
+        try:
+            for chunk, chunk_pairs in self.read_raw_chunks():
+                pairs.append(chunk_pairs)
+                rules.append(np.zeros(len(chunk), dtype=np.int8))
+                df = self.clean_chunk(chunk.set_axis(np.arange(len(chunk))), rules[-1], chunk.index[0])
+                weeks.append(np.full(len(chunk), -1, dtype=np.int16))
+                weeks[-1][df['ID'].values - chunk.index[0]] = df['SEM_PRI'].values
+                counts.append(df.groupby(['SG_UF_NOT', 'SEM_PRI'], observed=True).size())
+                table = self.to_table(df.sort_values(['SEM_PRI', 'ID']))
+                schema = schema or table.schema
+                for week, rows in split_weeks(table.cast(schema)):
+                    if week not in writers:
+                        writers[week] = pq.ParquetWriter(self.week_file(week, build_dir), schema)
+                    writers[week].write_table(rows)
+        finally:
+            for writer in writers.values():
+                writer.close()
+        keys = row_keys(np.concatenate(pairs))
+        rules = np.concatenate(rules)
+        pq.write_table(pa.table({ROW_KEY: keys, 'ID': np.arange(len(keys), dtype=np.int32),
+                                 'SEM_PRI': np.concatenate(weeks), 'RULE': rules}), f"{build_dir}/{KEYS_FILE}")
+        counts = pd.concat(counts).groupby(level=[0, 1], observed=True).sum()
+        self.write_manifest(build_dir, fingerprint, report_from_rules(rules), counts, len(keys))
+        self.replace_cache(build_dir)
+        self.df = None
+
+    def refresh(self) -> pd.DataFrame:
+        """ Updates the cache to a republished raw file. Only the key columns of the raw file are read to
+        match its rows to the cached ones by KEY_COLUMNS: rows with a new key are parsed, cleaned and staged
+        per week, rows whose key is gone are removed, and only the week files that gain or lose rows are
+        rewritten. Cached rows keep their ID, new rows get IDs after the last one. Edits that keep the
+        notification number and week are not detected, removing the cache rebuilds it.
+        Returns the rows added and removed per state and epidemiological week, which are also
+        applied to the cached counts"""
+        fingerprint = self.source_fingerprint()
+        manifest = self.read_manifest()
+        first_id = manifest['next_id']
+        keys = self.raw_keys()
+        index = pd.read_parquet(f"{self.cache_dir}/{KEYS_FILE}")
+        present = index[ROW_KEY].isin(keys).values
+        gone = index.loc[~present]
+        fresh_rows = np.flatnonzero(~pd.Series(keys).isin(index[ROW_KEY]).values)
+        fresh_rules = np.zeros(len(fresh_rows), dtype=np.int8)
+        fresh_weeks = np.full(len(fresh_rows), -1, dtype=np.int16)
+        staging_dir = f"{self.cache_dir}/staging"
+        shutil.rmtree(staging_dir, ignore_errors=True)
+        os.makedirs(staging_dir)
+        schema = self.cache_schema()
+
+        # stage the cleaned new rows per week, numbering them by their position among the new rows
+        writers, added = {}, []
+        try:
+            for chunk, _ in self.read_raw_chunks(fresh_rows):
+                df = self.clean_chunk(chunk.set_axis(np.searchsorted(fresh_rows, chunk.index)), fresh_rules, first_id)
+                fresh_weeks[df['ID'].values - first_id] = df['SEM_PRI'].values
+                added.append(df.groupby(['SG_UF_NOT', 'SEM_PRI'], observed=True).size())
+                for week, rows in split_weeks(self.to_table(df.sort_values(['SEM_PRI', 'ID'])).cast(schema)):
+                    if week not in writers:
+                        writers[week] = pq.ParquetWriter(f"{staging_dir}/added-{week:02d}.parquet", schema)
+                    writers[week].write_table(rows)
+        finally:
+            for writer in writers.values():
+                writer.close()
 
-    def beautify_dataframe(self):
-        """ Beautify the dataframe """
-        self.df.dropna(subset = ['UTI', "CS_RACA", "CS_SEXO", "VACINA_COV"], inplace=True)
-        self.df.fillna(9, inplace=True)
-        self.df.drop(self.df.loc[self.df['UTI']==9].index, inplace=True)
-        self.df.drop(self.df.loc[self.df['CS_SEXO']=="I"].index, inplace=True)
-        self.df.drop(self.df.loc[self.df['CS_RACA']==9].index, inplace=True)
-        self.df.drop(self.df.loc[self.df['DT_NASC']==9].index, inplace=True)
-        self.df.drop(self.df.loc[self.df['DT_SIN_PRI']==9].index, inplace=True)
-        self.df.drop(self.df.loc[self.df['VACINA_COV']==9].index, inplace=True)
-        self.df.dropna(inplace=True)
-
-        self.df['DT_SIN_PRI'] = pd.to_datetime(self.df['DT_SIN_PRI'], format='%d/%m/%Y')
-        self.df['DT_SIN_PRI'] = self.df['DT_SIN_PRI'].astype(int)
-        self.df['DT_SIN_PRI'] = self.df['DT_SIN_PRI'] / 10**9
-        self.df['DT_NASC'] = pd.to_datetime(self.df['DT_NASC'], format='%d/%m/%Y')
-        self.df['DT_NASC'] = self.df['DT_NASC'].astype(int)
-        self.df['DT_NASC'] = self.df['DT_NASC'] / 10**9
-        self.df['CS_SEXO'] = self.df['CS_SEXO'].map({'F': 0, 'M': 1})
-        self.df['UTI'] = self.df['UTI'].map({1: 1, 2: 0})
-        self.df['VACINA_COV'] = self.df['VACINA_COV'].map({1: 1, 2: 0})
+        # merge the staged rows into the weeks that changed, one week at a time
+        gone_ids = pa.array(gone['ID'].values, type=pa.int32())
+        removed = []
+        weeks = sorted(set(writers) | set(gone.loc[gone['SEM_PRI'] >= 0, 'SEM_PRI'].astype(int)))
+        for week in weeks:
+            parts = []
+            if os.path.isfile(self.week_file(week)):
+                table = pq.read_table(self.week_file(week))
+                dropped = pc.is_in(table['ID'], value_set=gone_ids)
+                removed.append(table.filter(dropped).select(['SG_UF_NOT', 'SEM_PRI']).to_pandas()
+                               .groupby(['SG_UF_NOT', 'SEM_PRI']).size())
+                parts.append(table.filter(pc.invert(dropped)))
+            if week in writers:
+                parts.append(pq.read_table(f"{staging_dir}/added-{week:02d}.parquet"))
+            pq.write_table(pa.concat_tables(parts).sort_by('ID'), f"{staging_dir}/{week:02d}.parquet")
+
+        index = pd.concat([index.loc[present], pd.DataFrame({
+            ROW_KEY: keys[fresh_rows], 'ID': np.arange(first_id, first_id + len(fresh_rows), dtype=np.int32),
+            'SEM_PRI': fresh_weeks, 'RULE': fresh_rules})])
+        pq.write_table(pa.Table.from_pandas(index, preserve_index=False), f"{staging_dir}/{KEYS_FILE}")
+        delta = pd.concat([
+            pd.concat(added).groupby(level=[0, 1], observed=True).sum().rename('added') if added else None,
+            pd.concat(removed).groupby(level=[0, 1]).sum().rename('removed') if removed else None,
+        ], axis=1).reindex(columns=['added', 'removed']).fillna(0).astype('int64')
+        delta.index = delta.index.set_names(['SG_UF_NOT', 'SEM_PRI'])
+        counts = self.week_counts().set_index(['SG_UF_NOT', 'SEM_PRI'])['counts']
+        counts = counts.add(delta['added'], fill_value=0).sub(delta['removed'], fill_value=0)
+
+        # without a manifest the cache is rebuilt, so a refresh interrupted from here is never half applied
+        os.remove(f"{self.cache_dir}/{MANIFEST_FILE}")
+        for week in weeks:
+            if pq.read_metadata(f"{staging_dir}/{week:02d}.parquet").num_rows:
+                os.replace(f"{staging_dir}/{week:02d}.parquet", self.week_file(week))
+            elif os.path.isfile(self.week_file(week)):
+                os.remove(self.week_file(week))
+        os.replace(f"{staging_dir}/{KEYS_FILE}", f"{self.cache_dir}/{KEYS_FILE}")
+        self.write_manifest(self.cache_dir, fingerprint, report_from_rules(index['RULE'].values), counts,
+                            first_id + len(fresh_rows))
+        shutil.rmtree(staging_dir)
+        self.df = None
+        return delta.reset_index()
+
+    def cleaning_report(self) -> pd.DataFrame:
+        """ Returns how many rows each cleaning rule removed from the raw file the cache was built from"""
+        report = self.read_manifest().get('report', {})
+        return pd.DataFrame({'rule': list(report), 'rows': list(report.values())})
+
+    def to_table(self, df) -> pa.Table:
+        """ Converts a processed dataframe to an arrow table with the SRAG_SCHEMA types.
+        Categories are stored as plain strings so chunks with different categories share a schema"""
+        for column in df.select_dtypes(include='object').columns:
+            # fillna(9) leaves ints mixed with strings, which parquet can't store
+            df[column] = df[column].astype(str)
+        table = pa.Table.from_pandas(df, preserve_index=False)
+        schema = pa.schema([
+            pa.field(field.name, ARROW_TYPES.get(SRAG_SCHEMA.get(field.name), field.type))
+            for field in table.schema
+        ], metadata=table.schema.metadata)
+        return table.cast(schema)
+
+    def write_manifest(self, cache_dir, fingerprint, report, counts, next_id):
+        """ Writes the manifest of a cache, tagged with the source fingerprint and the configuration.
+        counts is the number of cases per (state, week), next_id the ID of the next new row"""
+        manifest = {
+            'fingerprint': fingerprint,
+            'config': self.config_fingerprint(),
+            'report': report,
+            'next_id': int(next_id),
+            'counts': [[str(state), int(week), int(count)] for (state, week), count in counts.items() if count > 0],
+        }
+        partial_file = f"{cache_dir}/{MANIFEST_FILE}.partial"
+        with open(partial_file, 'w', encoding='utf-8') as f:
+            json.dump(manifest, f)
+        os.replace(partial_file, f"{cache_dir}/{MANIFEST_FILE}")
+
+    def replace_cache(self, build_dir):
+        """ Replaces the cache with the one built in build_dir"""
+        old_dir = f"{self.cache_dir}.old"
+        shutil.rmtree(old_dir, ignore_errors=True)
+        if os.path.isdir(self.cache_dir):
+            os.replace(self.cache_dir, old_dir)
+        os.replace(build_dir, self.cache_dir)
+        shutil.rmtree(old_dir, ignore_errors=True)
+
+    def write_cache(self, fingerprint):
+        """ Writes the processed dataframe as the cache. It has no row keys, so it can't be refreshed"""
+        build_dir = f"{self.cache_dir}.partial"
+        shutil.rmtree(build_dir, ignore_errors=True)
+        os.makedirs(f"{build_dir}/{WEEKS_DIR}")
+        for week, rows in split_weeks(self.to_table(self.df.sort_values(['SEM_PRI', 'ID']))):
+            pq.write_table(rows, self.week_file(week, build_dir))
+        counts = self.df.groupby(['SG_UF_NOT', 'SEM_PRI'], observed=True).size()
+        self.write_manifest(build_dir, fingerprint, {}, counts, self.df['ID'].max() + 1)
+        self.replace_cache(build_dir)
+
+    def beautify_dataframe(self, rules=None) -> dict:
+        """ Beautify the dataframe, removing the rows matched by REMOVAL_RULES in a single mask (rules,
+        as returned by removal_rules, can be given) and applying the remaps in one pass.
+        Returns the number of rows removed by each rule"""
+        if rules is None:
+            rules = removal_rules(self.df)
+        self.df = self.df.loc[rules == 0].fillna(MISSING_CODE)
+        for column in DATE_COLUMNS:
+            dates = pd.to_datetime(self.df[column], format='%d/%m/%Y').values
+            self.df[column] = dates.astype('datetime64[D]').astype('int32')
+        for column, codes in CODE_MAPS.items():
+            self.df[column] = self.df[column].map(codes)
+        self.df = apply_schema(self.df)
+        return report_from_rules(rules)
+
+    def week_counts(self) -> pd.DataFrame:
+        """ Returns a dataframe with the number of cases per state and epidemiological week,
+        kept in the cache manifest and updated by each refresh"""
+        return pd.DataFrame(self.read_manifest()['counts'], columns=['SG_UF_NOT', 'SEM_PRI', 'counts'])
 
     def state_counts(self):
         """ Returns a dataframe with the number of cases per state """
-        return self.df.groupby('SG_UF_NOT').size().reset_index(name='counts')
+        return self.week_counts().groupby('SG_UF_NOT')['counts'].sum().reset_index()
+
+    def partition_index(self) -> tuple:
+        """ Sorts the dataframe by region and state once and returns the row slices of each
+        state and of each region, so partitions are positional views instead of filtered copies"""
+        if self.partitions is None:
+            order = [state for states in REGIONS.values() for state in states]
+            order += sorted(set(self.df['SG_UF_NOT'].unique()) - set(order))
+            codes = pd.Categorical(self.df['SG_UF_NOT'], categories=order).codes
+            if (np.diff(codes) < 0).any():
+                sort = np.argsort(codes, kind='stable')
+                self.df = self.df.iloc[sort].reset_index(drop=True)
+                codes = codes[sort]
+            bounds = np.searchsorted(codes, np.arange(len(order) + 1))
+            state_slices = {state: slice(bounds[i], bounds[i + 1])
+                            for i, state in enumerate(order) if bounds[i] < bounds[i + 1]}
+            region_slices = {}
+            for region, states in REGIONS.items():
+                first, last = order.index(states[0]), order.index(states[-1])
+                region_slices[region] = slice(bounds[first], bounds[last + 1])
+            self.partitions = (state_slices, region_slices)
+        return self.partitions
 
     def state_data(self) -> dict:
         """ Returns a dictionary with the dataframes for each state """
-        dfs = {}
-        for state in self.df['SG_UF_NOT'].unique():
-            new_df = self.df.loc[self.df['SG_UF_NOT'] == state].copy()
-
-            dfs[state] = new_df
-        return dfs
+        state_slices, _ = self.partition_index()
+        return {state: self.df.iloc[rows] for state, rows in state_slices.items()}
 
     def region_data(self) -> dict:
         """ Returns a dictionary with the dataframes for each region """
-        regions = {
-            'sul': ['PR', 'SC', 'RS'],
-            'sudeste': ['SP', 'RJ', 'MG', 'ES'],
-            'centro_oeste': ['MS', 'MT', 'GO', 'DF'],
-            'nordeste': ['MA', 'PI', 'CE', 'RN', 'PE', 'PB', 'SE', 'AL', 'BA'],
-            'norte': ['AC', 'AP', 'AM', 'PA', 'RO', 'RR', 'TO']
-        }
-        dfs = {}
-        for region, states in regions.items():
-            new_df = self.df.loc[self.df['SG_UF_NOT'].isin(states)].copy()
-            dfs[region] = new_df
-        return dfs
+        _, region_slices = self.partition_index()
+        return {region: self.df.iloc[rows] for region, rows in region_slices.items()}
 
     def state_counts_normalized(self) -> pd.DataFrame:
         """ Returns a dataframe with the number of cases per state normalized by the population"""
         population = pd.read_csv("resources/datasets/IBGE2022.csv", sep=';', quotechar='"', encoding='utf-8')
-        new_df = self.df.groupby('SG_UF_NOT').size().reset_index(name='total').copy()
-        new_df['population'] = new_df['SG_UF_NOT'].map(population.set_index('UF')['POPULACAO'])
+        new_df = self.state_counts().rename(columns={'counts': 'total'})
+        # mapping a categorical column returns categories, map the state names instead
+        new_df['population'] = new_df['SG_UF_NOT'].astype(str).map(population.set_index('UF')['POPULACAO'])
         new_df['normalized'] = new_df['total']/new_df['population'] * 100000
         return new_df
 
+    def geographic_counts(self, attribute, privileged_group=1, target='VACINA_COV') -> dict:
+        """ Returns level -> BiasCounts of target for every level of GEOGRAPHIC_HIERARCHY. Only the
+        municipality counts scan the dataframe, each coarser level sums the counts of the level before it"""
+        key = (attribute, privileged_group, target)
+        if key not in self.geographic:
+            counts = PreTrainingBias().bias_counts(self.df, target, attribute, privileged_group, MUNICIPALITY_KEY)
+            levels = {}
+            for level, parent in GEOGRAPHIC_HIERARCHY.items():
+                counts = counts if parent is None else counts.rollup(parent)
+                levels[level] = counts
+            self.geographic[key] = levels
+        return self.geographic[key]
+
+    def geographic_metrics(self, attribute, privileged_group=1, target='VACINA_COV') -> pd.DataFrame:
+        """ Returns a tidy dataframe (level, id, CI, KL, KS) with the metrics of every municipality, state,
+        region and the country, all derived from the rolled up counts. Municipality ids are 'UF/name'"""
+        ptb = PreTrainingBias()
+        metrics = []
+        for level, counts in self.geographic_counts(attribute, privileged_group, target).items():
+            values = ptb.metrics_per_group(counts)
+            ids = ['/'.join(map(str, group)) if isinstance(group, tuple) else str(group) for group in values.index]
+            metrics.append(values.reset_index(drop=True).assign(level=level, id=ids))
+        return pd.concat(metrics, ignore_index=True)[['level', 'id', 'CI', 'KL', 'KS']]
+
+    def metric_per_state(self, metric, attribute, privileged_group=1) -> pd.DataFrame:
+        """ Returns a dataframe (id, metric) with the metric of each state """
+        metrics = self.geographic_metrics(attribute, privileged_group)
+        return metrics.loc[metrics['level'] == 'state', ['id', metric]].reset_index(drop=True)
+
+    def metric_per_region(self, metric, attribute, privileged_group=1) -> pd.DataFrame:
+        """ Returns a dataframe (id, metric) with the metric of the region of each state, for the state maps"""
+        metrics = self.geographic_metrics(attribute, privileged_group)
+        regions = metrics.loc[metrics['level'] == 'region'].set_index('id')[metric]
+        return pd.DataFrame([(state, value) for region, value in regions.items() for state in REGIONS[region]],
+                            columns=['id', metric])
+
     def kl_divergence_per_state(self, attribute, privileged_group=1) -> pd.DataFrame:
         """ Returns a dictionary with the KL divergence for each state """
-        dfs = {}
-        ptb = PreTrainingBias()
-        for state in self.df['SG_UF_NOT'].unique():
-            new_df = self.df.loc[self.df['SG_UF_NOT'] == state].copy()
-            dfs[state] = ptb.kl_divergence(new_df, 'VACINA_COV', attribute, privileged_group)
-        df = pd.DataFrame(dfs, index=['KL'])
-        df = pd.melt(df, value_vars=df.columns)
-        df.columns = ['id', 'KL']
-        return df
+        return self.metric_per_state('KL', attribute, privileged_group)
 
     def ks_per_state(self, attribute, privileged_group=1) -> pd.DataFrame:
         """ Returns a dictionary with the KS for each state """
-        dfs = {}
-        ptb = PreTrainingBias()
-        for state in self.df['SG_UF_NOT'].unique():
-            new_df = self.df.loc[self.df['SG_UF_NOT'] == state].copy()
-            dfs[state] = ptb.ks(new_df, 'VACINA_COV', attribute, privileged_group)
-        df = pd.DataFrame(dfs, index=['KS'])
-        df = pd.melt(df, value_vars=df.columns)
-        df.columns = ['id', 'KS']
-        return df
-
-    def ci_per_state(self, attribute) -> pd.DataFrame:
+        return self.metric_per_state('KS', attribute, privileged_group)
+
+    def ci_per_state(self, attribute, privileged_group=1) -> pd.DataFrame:
         """ Returns a dictionary with the class imbalance for each state """
-        dfs = {}
-        ptb = PreTrainingBias()
-        for state in self.df['SG_UF_NOT'].unique():
-            new_df = self.df.loc[self.df['SG_UF_NOT'] == state].copy()
-            dfs[state] = ptb.class_imbalance(new_df, attribute)
-        df = pd.DataFrame(dfs, index=['CI'])
-        df = pd.melt(df, value_vars=df.columns)
-        df.columns = ['id', 'CI']
-        return df
-
-    def ci_per_region(self, attribute) -> pd.DataFrame:
+        return self.metric_per_state('CI', attribute, privileged_group)
+
+    def metrics_per_week(self, attribute, privileged_group=1, window=1, group_variable=None) -> pd.DataFrame:
+        """ Returns a tidy dataframe (week, id, metric, value) with the CI, KL and KS of VACINA_COV for each
+        state over rolling windows of `window` epidemiological weeks, plus the CDDL when group_variable is given"""
+        values = PreTrainingBias().rolling_evaluation(self.df, 'VACINA_COV', 1, attribute, privileged_group,
+                                                      'SEM_PRI', 'SG_UF_NOT', window, group_variable)
+        values = values.rename(columns={'SEM_PRI': 'week', 'SG_UF_NOT': 'id'})
+        values['id'] = values['id'].astype(str)
+        return values
+
+    def ci_per_region(self, attribute, privileged_group=1) -> pd.DataFrame:
         """ Returns a dictionary with the class imbalance for each region"""
-        regions = {
-            'sul': ['PR', 'SC', 'RS'],
-            'sudeste': ['SP', 'RJ', 'MG', 'ES'],
-            'centro_oeste': ['MS', 'MT', 'GO', 'DF'],
-            'nordeste': ['MA', 'PI', 'CE', 'RN', 'PE', 'PB', 'SE', 'AL', 'BA'],
-            'norte': ['AC', 'AP', 'AM', 'PA', 'RO', 'RR', 'TO']
-        }
-        dfs = {}
-        ptb = PreTrainingBias()
-        for region, states in regions.items():
-            new_df = self.df.loc[self.df['SG_UF_NOT'].isin(regions[region])].copy()
-            region_ci = ptb.class_imbalance(new_df, attribute)
-            for state in states:
-                dfs[state] = region_ci
-        df = pd.DataFrame(dfs, index=['CI'])
-        df = pd.melt(df, value_vars=df.columns)
-        df.columns = ['id', 'CI']
-        return df
+        return self.metric_per_region('CI', attribute, privileged_group)
 
     def ks_per_region(self, attribute, privileged_group) -> pd.DataFrame:
         """ Returns a dictionary with the KS for each region"""
-        regions = {
-            'sul': ['PR', 'SC', 'RS'],
-            'sudeste': ['SP', 'RJ', 'MG', 'ES'],
-            'centro_oeste': ['MS', 'MT', 'GO', 'DF'],
-            'nordeste': ['MA', 'PI', 'CE', 'RN', 'PE', 'PB', 'SE', 'AL', 'BA'],
-            'norte': ['AC', 'AP', 'AM', 'PA', 'RO', 'RR', 'TO']
-        }
-        dfs = {}
-        ptb = PreTrainingBias()
-        for region, states in regions.items():
-            new_df = self.df.loc[self.df['SG_UF_NOT'].isin(regions[region])].copy()
-            region_ks = ptb.ks(new_df, 'VACINA_COV', attribute, privileged_group)
-            for state in states:
-                dfs[state] = region_ks
-        df = pd.DataFrame(dfs, index=['KS'])
-        df = pd.melt(df, value_vars=df.columns)
-        df.columns = ['id', 'KS']
-        return df
+        return self.metric_per_region('KS', attribute, privileged_group)
 
     def kl_per_region(self, attribute, privileged_group) -> pd.DataFrame:
         """ Returns a dictionary with the KL divergence for each region"""
-        regions = {
-            'sul': ['PR', 'SC', 'RS'],
-            'sudeste': ['SP', 'RJ', 'MG', 'ES'],
-            'centro_oeste': ['MS', 'MT', 'GO', 'DF'],
-            'nordeste': ['MA', 'PI', 'CE', 'RN', 'PE', 'PB', 'SE', 'AL', 'BA'],
-            'norte': ['AC', 'AP', 'AM', 'PA', 'RO', 'RR', 'TO']
-        }
-        dfs = {}
-        ptb = PreTrainingBias()
-        for region, states in regions.items():
-            new_df = self.df.loc[self.df['SG_UF_NOT'].isin(regions[region])].copy()
-            region_kl = ptb.kl_divergence(new_df, 'VACINA_COV', attribute, privileged_group)
-            for state in states:
-                dfs[state] = region_kl
-        df = pd.DataFrame(dfs, index=['KL'])
-        df = pd.melt(df, value_vars=df.columns)
-        df.columns = ['id', 'KL']
-        return df
-
-    def state_dataframes(self) -> pd.DataFrame:
+        return self.metric_per_region('KL', attribute, privileged_group)
+
+    def state_dataframes(self) -> dict:
         """ Returns a dictionary with the dataframes for each state """
-        dfs = {}
-        for state in self.df['SG_UF_NOT'].unique():
-            dfs[state] = self.df.loc[self.df['SG_UF_NOT'] == state].copy()
-        return dfs
+        return self.state_data()
@@ -0,0 +1,29 @@
+""" Module with the post training fairness metrics of the regional models"""
+import numpy as np
+import pandas as pd
+
+# cell 2 * actual + predicted of a binary target
+CONFUSION_CELLS = ['true negative', 'false positive', 'false negative', 'true positive']
+
+
+def group_confusion_rates(df: pd.DataFrame, attributes, predicted='predicted', actual='actual') -> pd.DataFrame:
+    """ Returns the confusion cells of every group of every protected attribute in attributes, normalized
+    by the size of the group, as a tidy dataframe (attribute, group, Output, count). All the attributes
+    are counted in a single bincount, rows with a missing group are left out of their attribute"""
+    cells = 2 * df[actual].to_numpy(dtype=np.intp) + df[predicted].to_numpy(dtype=np.intp)
+    codes, groups, offset = [], [], 0
+    for attribute in attributes:
+        group_codes, values = pd.factorize(df[attribute], sort=True)
+        codes.append(np.where(group_codes >= 0, (offset + group_codes) * 4 + cells, -1))
+        groups += [(attribute, value) for value in values]
+        offset += len(values)
+    codes = np.concatenate(codes)
+    counts = np.bincount(codes[codes >= 0], minlength=offset * 4).reshape(offset, 4)
+    totals = counts.sum(axis=1, keepdims=True)
+    rates = np.divide(counts, totals, out=np.zeros(counts.shape), where=totals != 0)
+    return pd.DataFrame({
+        'attribute': np.repeat([attribute for attribute, _ in groups], 4),
+        'group': np.repeat(np.array([value for _, value in groups], dtype=object), 4),
+        'Output': np.tile(CONFUSION_CELLS, offset),
+        'count': rates.ravel(),
+    })
@@ -0,0 +1,70 @@
+""" Module with the local geometry cache of the maps: state, region and municipality outlines,
+simplified at a few zoom tolerances, processed once and memoized per process"""
+import functools
+import hashlib
+import json
+import os
+import unicodedata
+import shapely
+from shapely.geometry import mapping, shape
+
+from topojson import QUANTIZATION, TOPOLOGY_VERSION, to_topojson
+
+# level -> (geojson file, feature properties joined by '/' as id, None for the feature id).
+# Municipality names repeat across states, their ids are 'UF/NAME' like the geographic metrics
+GEOMETRY_SOURCES = {
+    'states': ("resources/geojson/br_states.json", None),
+    'municipalities': ("resources/geojson/br_municipalities.json", ('uf', 'name')),
+}
+# simplification tolerance (degrees) of each zoom level
+ZOOM_TOLERANCES = {'country': 0.05, 'state': 0.01, 'detail': 0.0}
+GEOMETRY_CACHE_DIR = "resources/geojson/cache"
+
+
+def municipality_id(name) -> str:
+    """ Returns name the way ID_MUNICIP writes it, upper case without accents"""
+    return unicodedata.normalize('NFKD', str(name)).encode('ascii', 'ignore').decode().upper()
+
+
+@functools.lru_cache(maxsize=None)
+def read_features(level) -> tuple:
+    """ Returns the features of level read from its geojson file, with the id used by the maps"""
+    file_name, id_properties = GEOMETRY_SOURCES[level]
+    with open(file_name, encoding='utf-8') as json_data:
+        features = json.load(json_data)['features']
+    if id_properties is not None:
+        for feature in features:
+            feature['id'] = '/'.join(municipality_id(feature['properties'][name]) for name in id_properties)
+    return tuple(features)
+
+
+def region_features(regions) -> list:
+    """ Returns a feature per region of regions (region -> states), the union of its states"""
+    states = {feature['id']: shapely.make_valid(shape(feature['geometry'])) for feature in read_features('states')}
+    return [{'type': 'Feature', 'id': region, 'properties': {'states': members},
+             'geometry': mapping(shapely.union_all([states[state] for state in members if state in states]))}
+            for region, members in regions.items()]
+
+
+@functools.lru_cache(maxsize=None)
+def topology(level, zoom='state', regions=None) -> dict:
+    """ Returns the quantized topojson of level ('states', 'municipalities' or 'regions', which needs
+    regions as a tuple of (region, states) pairs) simplified for zoom. Shared borders are simplified
+    once, so neighbours stay joined. Topologies are stored in GEOMETRY_CACHE_DIR by source file, ids,
+    tolerance and quantization, so shapes are only processed once"""
+    file_name, id_properties = GEOMETRY_SOURCES['states' if level == 'regions' else level]
+    stat = os.stat(file_name)
+    key = hashlib.sha256(repr((level, regions, stat.st_size, stat.st_mtime_ns, id_properties, ZOOM_TOLERANCES[zoom],
+                               QUANTIZATION, TOPOLOGY_VERSION)).encode()).hexdigest()[:16]
+    cache_file = f"{GEOMETRY_CACHE_DIR}/{level}-{zoom}-{key}.json"
+    if os.path.isfile(cache_file):
+        with open(cache_file, encoding='utf-8') as f:
+            return json.load(f)
+
+    features = region_features(dict(regions)) if level == 'regions' else read_features(level)
+    result = to_topojson(features, f"br_{level}", tolerance=ZOOM_TOLERANCES[zoom])
+    os.makedirs(GEOMETRY_CACHE_DIR, exist_ok=True)
+    with open(f"{cache_file}.partial", 'w', encoding='utf-8') as f:
+        json.dump(result, f, separators=(',', ':'))
+    os.replace(f"{cache_file}.partial", cache_file)
+    return result
@@ -1,21 +1,42 @@
 #pylint: skip-file
 import json
 import geopandas as gpd
-from data import DataReader
+from data import DataReader, REGIONS
+from geometry import read_features, topology
+from render import RenderQueue
 import altair as alt
 import plotly.express as px
 import pandas as pd
 from pretrainingbias.pre_training_bias import PreTrainingBias
 
+# name of the shared states geometry in the Vega-Lite datasets, and of its TopoJSON object
+STATES_DATASET = "br_states"
+# regions as the hashable (region, states) pairs the geometry cache expects
+REGION_STATES = tuple((region, tuple(states)) for region, states in REGIONS.items())
+
+
 class MapRenderer:
     """ Class to render the maps"""
     
     @staticmethod
     def open_geojson():
-        """ Open the geojson file"""
-        with open("resources/geojson/br_states.json") as json_data:
-            d = json.load(json_data)
-        return d
+        """ Open the geojson file, parsed once per process"""
+        return {'type': 'FeatureCollection', 'features': list(read_features('states'))}
+
+    @staticmethod
+    def open_topojson(level='states', zoom='state'):
+        """ Returns the cached quantized topojson of 'states', 'regions' or 'municipalities', simplified for zoom"""
+        return topology(level, zoom, REGION_STATES if level == 'regions' else None)
+
+    @staticmethod
+    def states_data(level='states'):
+        """ Named reference to the geometry of level, charts using it must be saved with with_geometry"""
+        return alt.Data(name=f"br_{level}", format=alt.DataFormat(type='topojson', feature=f"br_{level}"))
+
+    @staticmethod
+    def with_geometry(chart, geometry, level='states'):
+        """ Adds the topology of level to a top level chart, as a single named dataset shared by its maps"""
+        return chart.properties(datasets={f"br_{level}": geometry})
 
     @staticmethod
     def gen_map(geodata, color_column, gdf, color_scheme='yelloworangered'):
@@ -30,37 +51,37 @@ class MapRenderer:
 
     @staticmethod
     def get_chart(df):
-        topodf = alt.topo_feature(
-            "https://raw.githubusercontent.com/fititnt/gis-dataset-brasil/master/uf/topojson/uf.json",
-            "uf",
-        )
-        return alt.Chart(topodf).mark_geoshape(stroke="white", strokeWidth=2).encode(
+        """ Returns the map of the number of cases per state, with the local states geometry"""
+        chart = alt.Chart(MapRenderer.states_data()).mark_geoshape(stroke="white", strokeWidth=2).encode(
             color=alt.Color(
                 "normalized:Q",
                 scale=alt.Scale(scheme="tealblues"),
                 legend=alt.Legend(title="Num of Cases"),
             ),
-            tooltip=[alt.Tooltip("properties.uf:O", title="UF"), alt.Tooltip("total:Q", title="Num of Cases"), alt.Tooltip("normalized:Q", title="Num of Cases per 100k")],
+            tooltip=[alt.Tooltip("id:O", title="UF"), alt.Tooltip("total:Q", title="Num of Cases"), alt.Tooltip("normalized:Q", title="Num of Cases per 100k")],
         ).transform_lookup(
             lookup="id",
             from_=alt.LookupData(
                 df, "SG_UF_NOT", ["total", 'normalized']
             ),
         ).properties(width=1280, height=720).project(
-            type="mercator", scale=1000, center=[-54, -15]).add_params(alt.selection_interval())
+            type="mercator", scale=1000, center=[-54, -15]).add_params(alt.selection_interval(name='area'))
+        return MapRenderer.with_geometry(chart, MapRenderer.open_topojson())
 
     @staticmethod
-    def make_html_maps(year):
-        json_gdf = MapRenderer.open_geojson()
+    def make_html_maps(year, render_queue=None):
+        """ Renders the maps of year. Charts go to render_queue when given, otherwise they are rendered at the end"""
+        queue = render_queue or RenderQueue()
+        states = MapRenderer.open_topojson()
 
-        data_reader = DataReader(year)
+        data_reader = DataReader(year, columns=['SG_UF_NOT', 'ID_MUNICIP', 'CS_RACA', 'CS_SEXO', 'VACINA_COV'])
         df =  data_reader.get_dataframe()
         uf_normalized_data = data_reader.state_counts_normalized()
    
-        data_geo = alt.Data(values=json_gdf['features'])
+        data_geo = MapRenderer.states_data()
         uf_normalized_data['id'] = uf_normalized_data['SG_UF_NOT']
 
-        pts = alt.selection_point( fields=['id'])
+        pts = alt.selection_point(name='state', fields=['id'])
 
         bar = alt.Chart(uf_normalized_data).mark_bar().encode(
             x=alt.X('normalized:Q', title="Num of Cases per 100k"),
@@ -88,6 +109,7 @@ class MapRenderer:
             opacity=alt.condition(pts, alt.value(1), alt.value(0.3))
         )
 
+        data_reader.df['CS_RACA_PRIVILEGED'] = data_reader.df['CS_RACA'].map({1: 1, 2: 0, 3: 0, 4:0, 5:0})
         dfs = data_reader.state_dataframes()
         _ptb = PreTrainingBias()
 
@@ -99,10 +121,9 @@ class MapRenderer:
         ks_perm = {}
         ks_orig = {}
         for state in dfs:
-            dfs[state]['CS_RACA_PRIVILEGED'] = dfs[state]['CS_RACA'].map({1: 1, 2: 0, 3: 0, 4:0, 5:0})
             ci_perm[state], ci_orig[state] = _ptb.get_class_imbalance_permutation_values(dfs[state], 'CS_RACA_PRIVILEGED', 100)
-            kl_perm[state], kl_orig[state] = _ptb.get_kl_divergence_permutation_values(dfs[state], 'VACINA_COV', 'CS_RACA_PRIVILEGED', 1, 100)
-            ks_perm[state], ks_orig[state] = _ptb.get_ks_permutation_values(dfs[state], 'VACINA_COV', 'CS_RACA_PRIVILEGED', 1, 100)
+            kl_perm[state], kl_orig[state] = _ptb.get_kl_divergence_permutation_values(dfs[state], 'VACINA_COV', 'CS_RACA_PRIVILEGED', 1, 100, method='exact')
+            ks_perm[state], ks_orig[state] = _ptb.get_ks_permutation_values(dfs[state], 'VACINA_COV', 'CS_RACA_PRIVILEGED', 1, 100, method='exact')
 
         ci_df_perm = pd.DataFrame(ci_perm)
         melted_ci_df_perm = pd.melt(ci_df_perm, value_vars=ci_df_perm.columns)
@@ -128,8 +149,6 @@ class MapRenderer:
 
         ks_orig_df = pd.DataFrame(ks_orig, index=['KS'])
 
-        data_reader.df['CS_RACA_PRIVILEGED'] = data_reader.df['CS_RACA'].map({1: 1, 2: 0, 3: 0, 4:0, 5:0})
-
         ci_chart = MapRenderer.get_metric_dispersion(melted_ci_df_perm, ci_orig_df, 'Class Imbalance', pts)
         kl_chart = MapRenderer.get_metric_dispersion(melted_kl_df_perm, kl_orig_df, 'KL Divergence', pts)
         ks_chart = MapRenderer.get_metric_dispersion(melted_ks_df_perm, ks_orig_df, 'KS', pts)
@@ -139,17 +158,21 @@ class MapRenderer:
         metrics_charts = alt.hconcat(ci_chart, kl_chart, ks_chart)
         chart = alt.vconcat(chart, metrics_charts, center=True, spacing=10, background='white', title=f"SRAG {year}" , bounds='full', autosize=alt.AutoSizeParams(type='fit', contains='padding'))
 
-        race_kl = MapRenderer.get_map(data_geo, year, "KL", data_reader.kl_per_region('CS_RACA_PRIVILEGED', 1), 'viridis', 'CS_RACA')
-        race_ks = MapRenderer.get_map(data_geo, year, "KS", data_reader.ks_per_region('CS_RACA_PRIVILEGED', 1), 'redyellowgreen', 'CS_RACA')
-        race_ci = MapRenderer.get_map(data_geo, year, "CI", data_reader.ci_per_region('CS_RACA_PRIVILEGED'), 'plasma', 'CS_RACA')
-        alt.hconcat(race_kl, race_ks, race_ci).resolve_scale(color='independent').save(f'resources/maps/race-{year}.html')
+        race_kl = MapRenderer.get_map(data_geo, year, "KL", data_reader.kl_per_region('CS_RACA_PRIVILEGED', 1), 'viridis', 'CS_RACA', queue, states)
+        race_ks = MapRenderer.get_map(data_geo, year, "KS", data_reader.ks_per_region('CS_RACA_PRIVILEGED', 1), 'redyellowgreen', 'CS_RACA', queue, states)
+        race_ci = MapRenderer.get_map(data_geo, year, "CI", data_reader.ci_per_region('CS_RACA_PRIVILEGED'), 'plasma', 'CS_RACA', queue, states)
+        race_maps = alt.hconcat(race_kl, race_ks, race_ci).resolve_scale(color='independent')
+        queue.add(MapRenderer.with_geometry(race_maps, states), f'resources/maps/race-{year}.html')
 
-        sex_kl = MapRenderer.get_map(data_geo, year, "KL", data_reader.kl_per_region('CS_SEXO', 1), 'viridis', 'CS_SEXO')
-        sex_ks = MapRenderer.get_map(data_geo, year, "KS", data_reader.ks_per_region('CS_SEXO', 1), 'redyellowgreen', 'CS_SEXO')
-        sex_ci = MapRenderer.get_map(data_geo, year, "CI", data_reader.ci_per_region('CS_SEXO'), 'plasma', 'CS_SEXO')
-        alt.hconcat(sex_kl, sex_ks, sex_ci).resolve_scale(color='independent').save(f'resources/maps/sex-{year}.html')
+        sex_kl = MapRenderer.get_map(data_geo, year, "KL", data_reader.kl_per_region('CS_SEXO', 1), 'viridis', 'CS_SEXO', queue, states)
+        sex_ks = MapRenderer.get_map(data_geo, year, "KS", data_reader.ks_per_region('CS_SEXO', 1), 'redyellowgreen', 'CS_SEXO', queue, states)
+        sex_ci = MapRenderer.get_map(data_geo, year, "CI", data_reader.ci_per_region('CS_SEXO'), 'plasma', 'CS_SEXO', queue, states)
+        sex_maps = alt.hconcat(sex_kl, sex_ks, sex_ci).resolve_scale(color='independent')
+        queue.add(MapRenderer.with_geometry(sex_maps, states), f'resources/maps/sex-{year}.html')
 
-        chart.save(f'resources/maps/{year}.html')
+        queue.add(MapRenderer.with_geometry(chart, states), f'resources/maps/{year}.html')
+        if render_queue is None:
+            queue.render()
 
     @staticmethod
     def get_metric_dispersion(permutations, original, metric_name, pts):
@@ -181,7 +204,9 @@ class MapRenderer:
         return c + original_line
 
     @staticmethod
-    def get_map(data_geo, year, metric_name, metric_df, color, attribute):
+    def get_map(data_geo, year, metric_name, metric_df, color, attribute, render_queue=None, states=None):
+        """ Returns the map of metric_name per state, saving it as png. The png embeds the states
+        topojson (the cached one by default) that data_geo refers to"""
         map = alt.Chart(data_geo).mark_geoshape(stroke="white", strokeWidth=2).encode(
             color=alt.Color(
                 f"{metric_name}:Q",
@@ -197,6 +222,10 @@ class MapRenderer:
         ).project(
             type="mercator").properties(width=1280, height=720)
 
-        map.save(f"resources/maps/{metric_name}-{year}-{attribute}-metrics.png")
+        png = MapRenderer.with_geometry(map, states or MapRenderer.open_topojson())
+        if render_queue is None:
+            png.save(f"resources/maps/{metric_name}-{year}-{attribute}-metrics.png")
+        else:
+            render_queue.add(png, f"resources/maps/{metric_name}-{year}-{attribute}-metrics.png")
 
         return map
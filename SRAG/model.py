@@ -1,34 +1,131 @@
 """ Module to train the model for a given year"""
-import pickle
+import hashlib
+import json
+import tempfile
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import numpy as np
 from sklearn.ensemble import RandomForestClassifier
 from sklearn.model_selection import train_test_split
 import pandas as pd
 from sklearn.metrics import confusion_matrix, accuracy_score, classification_report, f1_score
 from sklearn.neural_network import MLPClassifier
 import os
+import joblib
 
 from SRAG.data import DataReader
 
+# columns of the processed SRAG frame that are not model features
+NON_FEATURE_COLUMNS = ['UTI', 'VACINA_COV', 'SG_UF_NOT', 'ID_MUNICIP', 'SG_UF_INTE', 'SG_UF', "ID"]
+# columns kept next to the predictions, the row id and the protected attributes
+PREDICTION_COLUMNS = ['ID', 'CS_RACA', 'CS_SEXO']
+MODEL_PARAMS = {'n_estimators': 300, 'random_state': 42}
+# models are stored as <hash of data, target, features and parameters>.joblib
+MODEL_STORE_DIR = "resources/models"
+
+
+def fit_regional_model(x_file, y_file, model_file, tree_jobs):
+    """ Fits a random forest on training arrays memory mapped from .npy files, so workers share
+    them read-only through the page cache, and saves it to model_file"""
+    x_train = np.load(x_file, mmap_mode='r')
+    y_train = np.load(y_file, mmap_mode='r')
+    model = RandomForestClassifier(**MODEL_PARAMS, n_jobs=tree_jobs)
+    model.fit(x_train, y_train)
+    # the saved model should not depend on the machine it was trained on
+    model.set_params(n_jobs=None)
+    save_model(model, model_file)
+    return model_file
+
+
+def save_model(model, model_file):
+    """ Saves model through a partial file, so a partly written model is never read"""
+    joblib.dump(model, f"{model_file}.partial")
+    os.replace(f"{model_file}.partial", model_file)
+
+
+def train_regional_models(trainers, n_cores=None, retrain=False):
+    """ Trains the missing regional models of every trainer (all of them if retrain) concurrently.
+    The core budget (every core by default) is split between concurrent jobs and the trees of each forest"""
+    jobs = [(trainer, region) for trainer in trainers for region in trainer.region_data
+            if retrain or not os.path.isfile(trainer.model_file(region))]
+    if jobs:
+        n_cores = n_cores or os.cpu_count()
+        n_workers = min(len(jobs), n_cores)
+        tree_jobs = max(1, n_cores // n_workers)
+        print(f"Training {len(jobs)} models on {n_workers} workers with {tree_jobs} cores each")
+        with tempfile.TemporaryDirectory() as arrays_dir, ProcessPoolExecutor(max_workers=n_workers) as executor:
+            futures = []
+            for trainer, region in jobs:
+                x_train, _, y_train, _ = trainer.train_test_split(trainer.region_data[region])
+                x_file, y_file = f"{arrays_dir}/{trainer.year}-{region}-x.npy", f"{arrays_dir}/{trainer.year}-{region}-y.npy"
+                np.save(x_file, x_train.to_numpy(dtype=np.float32))
+                np.save(y_file, y_train.to_numpy())
+                os.makedirs(MODEL_STORE_DIR, exist_ok=True)
+                futures.append(executor.submit(fit_regional_model, x_file, y_file, trainer.model_file(region), tree_jobs))
+            for future in futures:
+                future.result()
+        for trainer, region in jobs:
+            # a retrained model replaces the loaded one on next use
+            trainer.models.pop(region, None)
+
+
 class ModelTrainer:
     """ Class to train the model for a given year"""
     year = ""
-    region_data = {}
-    models = {}
     dataReader = None
 
-    def __init__(self, year, target, skip_train=False):
-        """ Initialize the model trainer"""
+    def __init__(self, year, target, skip_train=False, n_cores=None, data_reader=None):
+        """ Initialize the model trainer. n_cores is the core budget used when models have to be trained,
+        data_reader an already loaded DataReader of year"""
         self.year = year
-        self.data_reader = DataReader(year)
+        self.data_reader = data_reader or DataReader(year)
         self.region_data = self.data_reader.region_data()
+        self.models = {}
         self.target = target
         self.skip_train = skip_train
+        self.n_cores = n_cores
         if not skip_train:
-            self.load_all_models()
+            # models are only loaded when first used
+            train_regional_models([self], self.n_cores)
+
+    def features(self) -> list:
+        """ Returns the feature columns of the models"""
+        return [column for column in self.data_reader.df.columns if column not in NON_FEATURE_COLUMNS]
+
+    def model_key(self, region, target=None, params=None) -> str:
+        """ Returns the hash addressing the model of region in the store. It changes with the
+        training data, target, features and estimator parameters, so stale models are never reused"""
+        if params is None:
+            params = RandomForestClassifier(**MODEL_PARAMS).get_params()
+        key = {
+            'data': self.data_reader.cache_fingerprint(),
+            'year': self.year,
+            'region': region,
+            'rows': len(self.region_data[region]),
+            'target': target or self.target,
+            'features': self.features(),
+            'params': params,
+        }
+        return hashlib.sha256(json.dumps(key, sort_keys=True, default=str).encode()).hexdigest()
+
+    def model_file(self, region, target=None, params=None) -> str:
+        """ Returns the file of the model of region in the store"""
+        return f'{MODEL_STORE_DIR}/{self.model_key(region, target, params)}.joblib'
+
+    def get_model(self, region):
+        """ Returns the model of region, loading it on first use"""
+        if region not in self.models:
+            self.models[region] = joblib.load(self.model_file(region))
+        return self.models[region]
+
+    def train_test_split(self, df: pd.DataFrame) -> list:
+        """ Splits the features and target of df into train and test sets"""
+        x = df.drop(columns=NON_FEATURE_COLUMNS)
+        y = df[self.target]
+        return train_test_split(x, y, test_size=0.2, random_state=42)
 
     def train_and_save_regional_model_for_year(self, df: pd.DataFrame, region: str, model, target: str):
         """ Train a model for all states, writing the saved model to a file"""
-        x = df.drop(columns=['UTI', 'VACINA_COV', 'SG_UF_NOT', 'ID_MUNICIP', 'SG_UF_INTE', 'SG_UF', "ID" ])
+        x = df.drop(columns=NON_FEATURE_COLUMNS)
         y = df[target]
         x_train, x_test, y_train, y_test = train_test_split(x, y, test_size=0.2, random_state=42)
 
@@ -41,43 +138,38 @@ class ModelTrainer:
         # print(f"Classification Report for {region}: ")
         # print(classification_report(y_test, pred_model))
 
-        filename = f'resources/models/{self.year}/{region}.sav'
-        self.models[region] = model
-        with open(filename, 'wb') as f:
-            pickle.dump(model, f)
+        filename = self.model_file(region, target, model.get_params())
+        if target == self.target:
+            self.models[region] = model
+        os.makedirs(MODEL_STORE_DIR, exist_ok=True)
+        save_model(model, filename)
 
     def generate_regional_models(self, target):
-        """ Generate a model for each region"""
-        for region, df in self.region_data.items():
-            model = RandomForestClassifier(n_estimators=300, random_state=42)
-            self.train_and_save_regional_model_for_year(df, region, model, target)
-
-    def load_all_models(self) -> dict:
-        """ Load all models from a file"""
-        need_to_train = False
+        """ Generate a model for each region, training them in parallel"""
+        self.target = target
+        train_regional_models([self], self.n_cores, retrain=True)
+
+    def load_all_models(self, train_missing=True) -> dict:
+        """ Load all models from the store, training the missing ones"""
+        if train_missing:
+            train_regional_models([self], self.n_cores)
         for region in self.region_data:
-            filename = f'resources/models/{self.year}/{region}.sav'
-            if os.path.isfile(filename):
-                with open(filename, 'rb') as f:
-                    loaded_model = pickle.load(f)
-                print("Found trained model, using it")
-                self.models[region] = loaded_model
-            else:
-                need_to_train = True
-        if need_to_train:
-            print("Models not found, training them")
-            self.generate_regional_models(self.target)
+            if os.path.isfile(self.model_file(region)):
+                self.get_model(region)
+        return self.models
 
     def predict_for_region(self, model_region, predicted_region) -> list:
         """ Predicts for a given region"""
         print(f"Predicting for {self.year} with target {self.target}")
-        model = self.models[model_region]
+        model = self.get_model(model_region)
         target_data = self.region_data[predicted_region]
 
-        x = target_data.drop(columns=['UTI', 'VACINA_COV', 'SG_UF_NOT', 'ID_MUNICIP', 'SG_UF_INTE', 'SG_UF', "ID" ])
+        # the models are fit on float32 arrays, predicting on a frame warns about feature names
+        x = target_data.drop(columns=NON_FEATURE_COLUMNS).to_numpy(dtype=np.float32)
         y = target_data[self.target]
 
-        y_pred = model.predict(x)
+        probability = model.predict_proba(x)
+        y_pred = model.classes_[probability.argmax(axis=1)]
         # print(f"Confusion Matrix for {predicted_region} on model trained for {model_region}: ")
         # print(confusion_matrix(y, y_pred))
         # print(f"Classification Report for {predicted_region} on model trained for {model_region}: ")
@@ -87,12 +179,66 @@ class ModelTrainer:
 
         print(f"acurácia de {acc} treinando para {predicted_region} com {model_region}")
 
-        x['predicted'] = y_pred
-        x['actual'] = y
-        file_path = f"resources/datasets/{self.year}/{model_region}"
-        if not os.path.exists(file_path):
-            os.makedirs(file_path)
-        
-        x.to_csv(f"{file_path}/{predicted_region}.csv")
+        self.save_predictions(model_region, predicted_region, model, probability)
+
+        return [round(acc, 4), round(f1, 4)]
+
+    def prediction_file(self, model_region, predicted_region) -> str:
+        """ Returns the partition of the prediction store holding the predictions of the model of
+        model_region for predicted_region"""
+        return f"resources/datasets/{self.year}/predictions/model={model_region}/region={predicted_region}/predictions.parquet"
+
+    def save_predictions(self, model_region, predicted_region, model, probability):
+        """ Writes the row ids and protected attributes of predicted_region with the prediction,
+        the probability of the positive class and the actual target to the prediction store"""
+        target_data = self.region_data[predicted_region]
+        predictions = target_data[PREDICTION_COLUMNS].assign(
+            predicted=model.classes_[probability.argmax(axis=1)].astype(np.int8),
+            probability=probability[:, list(model.classes_).index(1)].astype(np.float32),
+            actual=target_data[self.target].astype(np.int8))
+        file_name = self.prediction_file(model_region, predicted_region)
+        os.makedirs(os.path.dirname(file_name), exist_ok=True)
+        predictions.to_parquet(file_name, index=False)
+
+    def read_predictions(self, model_region, predicted_region) -> pd.DataFrame:
+        """ Reads the predictions of the model of model_region for predicted_region"""
+        return pd.read_parquet(self.prediction_file(model_region, predicted_region))
+
+    def evaluate_all(self, n_jobs=1, save_predictions=True) -> tuple:
+        """ Predicts every region with the model of every region, building each feature matrix once.
+        Returns the accuracy and F1 matrices (a column per predicted region, a row per model) and the
+        confusion counts (tn, fp, fn, tp) of every (model, region) pair. Models run on n_jobs threads (-1 for every core):
+        tree traversal releases the GIL, so the feature matrices are shared without copies"""
+        print(f"Evaluating {self.year} with target {self.target}")
+        regions = list(self.region_data)
+        features = {region: df.drop(columns=NON_FEATURE_COLUMNS).to_numpy(dtype=np.float32)
+                    for region, df in self.region_data.items()}
+        actual = {region: df[self.target].to_numpy(dtype=np.intp) for region, df in self.region_data.items()}
+        models = {region: self.get_model(region) for region in regions}
+
+        def predict_regions(model_region):
+            return [models[model_region].predict_proba(features[region]) for region in regions]
+
+        n_jobs = os.cpu_count() if n_jobs == -1 else n_jobs
+        with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+            predictions = dict(zip(regions, executor.map(predict_regions, regions)))
+
+        counts = []
+        for model_region in regions:
+            classes = models[model_region].classes_
+            for region, probability in zip(regions, predictions[model_region]):
+                y_pred = classes[probability.argmax(axis=1)]
+                # cell 2 * actual + predicted of a binary target is tn, fp, fn, tp
+                counts.append(np.bincount(2 * actual[region] + y_pred.astype(np.intp), minlength=4))
+                if save_predictions:
+                    self.save_predictions(model_region, region, models[model_region], probability)
+        confusion = pd.DataFrame(counts, columns=['tn', 'fp', 'fn', 'tp'],
+                                 index=pd.MultiIndex.from_product([regions, regions], names=['model', 'region']))
+        acc = (confusion['tn'] + confusion['tp']) / confusion.sum(axis=1)
+        f1 = (2 * confusion['tp'] / (2 * confusion['tp'] + confusion['fp'] + confusion['fn'])).fillna(0.0)
+
+        def matrix(values):
+            values = values.round(4).unstack('region').reindex(index=regions, columns=regions)
+            return values.rename(index=lambda region: f"model {region}").rename_axis(index=None, columns=None)
 
-        return [round(acc, 4), round(f1, 4)]
\ No newline at end of file
+        return matrix(acc), matrix(f1), confusion
\ No newline at end of file
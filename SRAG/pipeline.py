@@ -0,0 +1,155 @@
+""" Module to run the SRAG experiments as cached stages: ingest and clean -> split by region -> train ->
+cross-predict -> fairness metrics -> charts, one chain per year"""
+import hashlib
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+import altair as alt
+import joblib
+import pandas as pd
+
+from SRAG.data import DataReader
+from SRAG.fairness import group_confusion_rates
+from SRAG.model import MODEL_PARAMS, ModelTrainer, train_regional_models
+from SRAG.render import RenderQueue
+
+# year -> target of the regional models
+EXPERIMENTS = {'2021': 'UTI', '2022': 'VACINA_COV', '2023': 'VACINA_COV'}
+# cached stage outputs are stored as <stage>-<fingerprint>.joblib
+STAGE_CACHE_DIR = "resources/pipeline"
+# protected attributes of the fairness charts, group 1 being the privileged one
+FAIRNESS_ATTRIBUTES = {'CS_RACA_PRIVILEGED': 'Race', 'CS_SEXO': 'Sex'}
+
+
+class Stage:
+    """ Step of the pipeline. run is called with the outputs of the inputs stages. The fingerprint of a
+    stage hashes its name, params and the fingerprints of its inputs, or source() for stages without inputs.
+    Outputs of cached stages are stored by fingerprint, so a stage only reruns when something upstream changed.
+    Stages that are not cached rely on their own caches (parquet cache, model store, render queue).
+    is_valid checks a cached output can still be used, e.g. that the files it refers to exist"""
+
+    def __init__(self, name, run, inputs=(), params=None, source=None, cached=False, is_valid=None):
+        self.name = name
+        self.run = run
+        self.inputs = list(inputs)
+        self.params = params or {}
+        self.source = source
+        self.cached = cached
+        self.is_valid = is_valid
+
+
+class Pipeline:
+    """ Runs the stages of every experiment, the chains of different years in parallel"""
+
+    def __init__(self, experiments=None, n_cores=None):
+        """ Initialize the pipeline. The core budget (every core by default) is split between the years"""
+        self.experiments = experiments or EXPERIMENTS
+        self.cores_per_year = max(1, (n_cores or os.cpu_count()) // len(self.experiments))
+        self.stages = {}
+        self.fingerprints = {}
+        self.outputs = {}
+        self.render_queue = RenderQueue()
+        for year, target in self.experiments.items():
+            self.add_experiment(year, target)
+
+    def add(self, stage):
+        """ Adds a stage to the pipeline"""
+        self.stages[stage.name] = stage
+
+    def add_experiment(self, year, target):
+        """ Adds the stages of the experiment of year"""
+        self.add(Stage(f'clean-{year}', lambda: DataReader(year),
+                       source=lambda: DataReader(year, load=False).fingerprint()))
+        self.add(Stage(f'regions-{year}', lambda data_reader: ModelTrainer(year, target, skip_train=True,
+                                                                           n_cores=self.cores_per_year,
+                                                                           data_reader=data_reader),
+                       inputs=[f'clean-{year}'], params={'target': target}))
+        self.add(Stage(f'train-{year}', self.train, inputs=[f'regions-{year}'], params={'model': MODEL_PARAMS}))
+        self.add(Stage(f'predict-{year}', self.cross_predict, inputs=[f'train-{year}'], cached=True,
+                       is_valid=self.predictions_exist))
+        self.add(Stage(f'fairness-{year}', self.fairness_rates, inputs=[f'train-{year}', f'predict-{year}'],
+                       cached=True))
+        self.add(Stage(f'charts-{year}', lambda rates: self.fairness_charts(year, rates),
+                       inputs=[f'fairness-{year}']))
+
+    def fingerprint(self, name) -> str:
+        """ Returns the fingerprint of a stage, without running anything"""
+        if name not in self.fingerprints:
+            stage = self.stages[name]
+            key = {
+                'name': name,
+                'params': stage.params,
+                'inputs': [self.fingerprint(input_name) for input_name in stage.inputs],
+                'source': stage.source() if stage.source else None,
+            }
+            self.fingerprints[name] = hashlib.sha256(json.dumps(key, sort_keys=True).encode()).hexdigest()
+        return self.fingerprints[name]
+
+    def get(self, name):
+        """ Returns the output of a stage, from its cache or running it and the stages it needs"""
+        if name not in self.outputs:
+            stage = self.stages[name]
+            cache_file = f"{STAGE_CACHE_DIR}/{name}-{self.fingerprint(name)}.joblib"
+            if stage.cached and os.path.isfile(cache_file):
+                self.outputs[name] = joblib.load(cache_file)
+                if stage.is_valid is None or stage.is_valid(self.outputs[name]):
+                    print(f"Stage {name} is up to date")
+                    return self.outputs[name]
+                print(f"Stage {name} is cached but its files are gone")
+            print(f"Running stage {name}")
+            self.outputs[name] = stage.run(*[self.get(input_name) for input_name in stage.inputs])
+            if stage.cached:
+                os.makedirs(STAGE_CACHE_DIR, exist_ok=True)
+                joblib.dump(self.outputs[name], cache_file)
+        return self.outputs[name]
+
+    def run(self):
+        """ Runs the chain of every year up to its charts, then renders the charts that changed"""
+        with ThreadPoolExecutor(max_workers=len(self.experiments)) as executor:
+            list(executor.map(self.get, [f'charts-{year}' for year in self.experiments]))
+        self.render_queue.render()
+
+    def train(self, trainer):
+        """ Trains the missing regional models of the trainer"""
+        train_regional_models([trainer], self.cores_per_year)
+        return trainer
+
+    def cross_predict(self, trainer):
+        """ Predicts every region with the model of every region, writing the acc/f1 matrices.
+        Returns them with the confusion matrices and the prediction partitions written"""
+        acc, f1, confusion = trainer.evaluate_all(n_jobs=self.cores_per_year)
+        acc.to_csv(f"resources/datasets/acc-{trainer.year}.csv")
+        f1.to_csv(f"resources/datasets/f1-{trainer.year}.csv")
+        files = [trainer.prediction_file(model_region, region)
+                 for model_region in trainer.region_data for region in trainer.region_data]
+        return acc, f1, confusion, files
+
+    @staticmethod
+    def predictions_exist(predictions) -> bool:
+        """ Checks the prediction partitions of a cached predict stage are still on disk"""
+        *_, files = predictions
+        return all(os.path.isfile(file_name) for file_name in files)
+
+    def fairness_rates(self, trainer, _):
+        """ Returns the group confusion rates of every (model, region) pair"""
+        rates = []
+        for model_region in trainer.region_data:
+            for region in trainer.region_data:
+                df = trainer.read_predictions(model_region, region)
+                df['CS_RACA_PRIVILEGED'] = df['CS_RACA'].map({1: 1, 2: 0, 3: 0, 4: 0, 5: 0})
+                rates.append(group_confusion_rates(df, FAIRNESS_ATTRIBUTES).assign(model=model_region, region=region))
+        rates = pd.concat(rates, ignore_index=True)
+        rates['index'] = rates['group'].map({0: 'unprivileged', 1: 'privileged'})
+        return rates
+
+    def fairness_charts(self, year, rates):
+        """ Queues the normalized confusion charts of every (model, region) pair and attribute"""
+        for (model_region, region, attribute), chart_rates in rates.groupby(['model', 'region', 'attribute'], sort=False):
+            name = FAIRNESS_ATTRIBUTES[attribute]
+            chart = alt.Chart(chart_rates.drop(columns=['model', 'region'])).mark_bar().encode(
+                x=alt.X('index:O', axis=alt.Axis(title='Class')),
+                y=alt.Y('count:Q', axis=alt.Axis(title='')),
+                color=alt.Color('index:N', legend=alt.Legend(title='Class')),
+                column= alt.Column('Output:N'),
+            ).properties(width=200, height='container', title=f'{year} model trained on {model_region}, inference on region {region} - {name} (Normalized)')
+            self.render_queue.add(chart, f"resources/charts/{year}/Normalized-{name.lower()}-{year}-model-{model_region}-region-{region}.png")
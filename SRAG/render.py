@@ -0,0 +1,78 @@
+""" Module to render the charts to files on a process pool, skipping the charts that did not change"""
+import hashlib
+import json
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor
+
+# file name -> hash of the Vega-Lite spec the file was rendered from
+RENDER_CACHE_FILE = "resources/render_cache.json"
+# names altair generates for unnamed params and views, they keep counting across the charts of a process
+AUTO_NAME = re.compile(r'\b(?:param|view)_\d+\b')
+
+
+def spec_hash(chart) -> str:
+    """ Returns the hash of the Vega-Lite spec of chart, data included. Generated names are
+    renumbered in order of appearance, so the same chart hashes the same when built again"""
+    names = {}
+    spec = AUTO_NAME.sub(lambda match: names.setdefault(match.group(), f"auto_{len(names)}"),
+                         json.dumps(chart.to_dict(), sort_keys=True))
+    return hashlib.sha256(spec.encode()).hexdigest()
+
+
+def render_chart(chart, file_name) -> str:
+    """ Saves chart to file_name, in the format given by its extension"""
+    os.makedirs(os.path.dirname(file_name) or '.', exist_ok=True)
+    chart.save(file_name)
+    return file_name
+
+
+class RenderQueue:
+    """ Queue of charts to save. Queued charts are rendered on a process pool by render (or when
+    the with block ends), skipping the ones whose spec hash matches the one their file was rendered from"""
+
+    def __init__(self, n_jobs=-1, cache_file=RENDER_CACHE_FILE):
+        """ Initialize the queue. n_jobs is the number of rendering processes, -1 uses every core"""
+        self.n_jobs = os.cpu_count() if n_jobs == -1 else n_jobs
+        self.cache_file = cache_file
+        self.charts = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.render()
+
+    def add(self, chart, file_name):
+        """ Queues chart to be saved to file_name"""
+        self.charts[file_name] = chart
+
+    def read_cache(self) -> dict:
+        """ Returns the spec hash of every file already rendered"""
+        if not os.path.isfile(self.cache_file):
+            return {}
+        with open(self.cache_file, 'r', encoding='utf-8') as f:
+            return json.load(f)
+
+    def render(self) -> list:
+        """ Renders the queued charts whose spec changed or whose file is missing,
+        returns the rendered file names"""
+        cache = self.read_cache()
+        hashes = {file_name: spec_hash(chart) for file_name, chart in self.charts.items()}
+        pending = [file_name for file_name, digest in hashes.items()
+                   if cache.get(file_name) != digest or not os.path.isfile(file_name)]
+        print(f"Rendering {len(pending)} of {len(hashes)} charts")
+        if self.n_jobs == 1 or len(pending) <= 1:
+            for file_name in pending:
+                render_chart(self.charts[file_name], file_name)
+        else:
+            with ProcessPoolExecutor(max_workers=min(self.n_jobs, len(pending))) as executor:
+                list(executor.map(render_chart, [self.charts[file_name] for file_name in pending], pending))
+
+        cache.update({file_name: hashes[file_name] for file_name in pending})
+        os.makedirs(os.path.dirname(self.cache_file) or '.', exist_ok=True)
+        with open(self.cache_file, 'w', encoding='utf-8') as f:
+            json.dump(cache, f, indent=1, sort_keys=True)
+        self.charts = {}
+        return pending
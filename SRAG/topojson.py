@@ -0,0 +1,125 @@
+""" Module to convert GeoJSON features to compact, quantized TopoJSON with shared borders"""
+import numpy as np
+import pandas as pd
+import shapely
+
+# cells of the grid the coordinates are snapped to, on each axis
+QUANTIZATION = 10_000
+# bumped when the output of to_topojson changes, so cached topologies are built again
+TOPOLOGY_VERSION = 2
+
+
+def ring_cells(ring, translate, scale) -> np.ndarray:
+    """ Returns the grid cells of a closed ring, without repeated consecutive cells nor the closing one"""
+    cells = np.rint((np.asarray(ring, dtype=float)[:, :2] - translate) / scale).astype(np.int64)
+    cells = cells[np.concatenate(([True], (np.diff(cells, axis=0) != 0).any(axis=1)))]
+    if len(cells) > 1 and (cells[0] == cells[-1]).all():
+        cells = cells[:-1]
+    return cells
+
+
+def junctions(rings) -> np.ndarray:
+    """ Returns the cell keys where borders stop being shared: cells the rings go through
+    with different neighbours"""
+    visits = []
+    for keys in rings:
+        previous, following = np.roll(keys, 1), np.roll(keys, -1)
+        visits.append(np.column_stack([keys, np.minimum(previous, following), np.maximum(previous, following)]))
+    if not visits:
+        return np.empty(0, dtype=np.int64)
+    visits = pd.DataFrame(np.concatenate(visits), columns=['cell', 'first', 'second']).drop_duplicates()
+    neighbours = visits.groupby('cell').size()
+    return neighbours.index[neighbours > 1].to_numpy()
+
+
+def ring_arcs(keys, shared) -> list:
+    """ Cuts a ring of cell keys at its junctions into arcs sharing their ends. A ring without
+    junctions is a single closed arc starting at its smallest cell, so equal rings give equal arcs"""
+    cuts = np.flatnonzero(np.isin(keys, shared))
+    if len(cuts) == 0:
+        ring = np.roll(keys, -int(np.argmin(keys)))
+        return [np.append(ring, ring[0])]
+    ring = np.roll(keys, -cuts[0])
+    ring = np.append(ring, ring[0])
+    cuts = np.append(cuts - cuts[0], len(keys))
+    return [ring[start:end + 1] for start, end in zip(cuts[:-1], cuts[1:])]
+
+
+def simplify_arc(cells, scale, tolerance) -> np.ndarray:
+    """ Simplifies the cells of an arc with Douglas-Peucker at tolerance (in coordinate units), keeping its ends"""
+    if not tolerance or len(cells) < 3:
+        return cells
+    line = shapely.LineString(cells * scale).simplify(tolerance, preserve_topology=False)
+    return np.rint(np.asarray(line.coords) / scale).astype(np.int64)
+
+
+def to_topojson(features, object_name, quantization=QUANTIZATION, tolerance=0.0) -> dict:
+    """ Converts GeoJSON (Multi)Polygon features to a TopoJSON topology with a single object_name
+    geometry collection. Coordinates are snapped to a quantization x quantization grid over the
+    bounding box and delta encoded. Rings are cut where neighbouring borders meet, so a border shared
+    by two shapes is a single arc, simplified once at tolerance: neighbours stay joined without gaps
+    or overlaps. Rings collapsing below a triangle keep their arcs unsimplified, rings already
+    collapsed by the grid are dropped. Feature ids and properties are kept"""
+    polygons = [feature['geometry']['coordinates'] if feature['geometry']['type'] == 'MultiPolygon'
+                else [feature['geometry']['coordinates']] for feature in features]
+    points = np.concatenate([np.asarray(ring, dtype=float)[:, :2]
+                             for polygon_list in polygons for polygon in polygon_list for ring in polygon])
+    translate = points.min(axis=0)
+    scale = (points.max(axis=0) - translate) / (quantization - 1)
+    scale[scale == 0] = 1.0
+
+    # rings as cell keys x * quantization + y
+    rings = []
+    for polygon_list in polygons:
+        kept = []
+        for polygon in polygon_list:
+            cells = [ring_cells(ring, translate, scale) for ring in polygon]
+            if len(cells[0]) >= 3:
+                kept.append([ring[:, 0] * quantization + ring[:, 1] for ring in cells if len(ring) >= 3])
+        rings.append(kept)
+    shared = junctions([keys for polygon_list in rings for polygon in polygon_list for keys in polygon])
+
+    arcs, arc_index = [], {}
+
+    def arc_id(arc) -> int:
+        """ Returns the index of arc, ~index when it is stored reversed"""
+        if arc.tobytes() in arc_index:
+            return arc_index[arc.tobytes()]
+        if arc[::-1].tobytes() in arc_index:
+            return ~arc_index[arc[::-1].tobytes()]
+        arc_index[arc.tobytes()] = len(arcs)
+        arcs.append(np.column_stack([arc // quantization, arc % quantization]))
+        return len(arcs) - 1
+
+    topology = [[[[arc_id(arc) for arc in ring_arcs(keys, shared)] for keys in polygon]
+                 for polygon in polygon_list] for polygon_list in rings]
+
+    simplified = [simplify_arc(cells, scale, tolerance) for cells in arcs]
+    for polygon_list in topology:
+        for polygon in polygon_list:
+            for ring in polygon:
+                indexes = [index if index >= 0 else ~index for index in ring]
+                if sum(len(simplified[index]) - 1 for index in indexes) < 3:
+                    for index in indexes:
+                        simplified[index] = arcs[index]
+
+    geometries = []
+    for feature, polygon_list in zip(features, topology):
+        if not polygon_list:
+            geometry = {'type': None}
+        elif feature['geometry']['type'] == 'MultiPolygon':
+            geometry = {'type': 'MultiPolygon', 'arcs': polygon_list}
+        else:
+            geometry = {'type': 'Polygon', 'arcs': polygon_list[0]}
+        if 'id' in feature:
+            geometry['id'] = feature['id']
+        if feature.get('properties'):
+            geometry['properties'] = feature['properties']
+        geometries.append(geometry)
+
+    return {
+        'type': 'Topology',
+        'transform': {'scale': scale.tolist(), 'translate': translate.tolist()},
+        'objects': {object_name: {'type': 'GeometryCollection', 'geometries': geometries}},
+        'arcs': [np.concatenate([cells[:1], np.diff(cells, axis=0)]).tolist() for cells in simplified],
+    }
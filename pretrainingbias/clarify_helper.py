@@ -1,22 +1,43 @@
 # pylint: skip-file
 import numpy as np
-from functional import seq
-from typing import List
+from typing import List, Tuple
 
 # Code borrowed from https://github.com/aws/amazon-sagemaker-clarify/blob/53cb4172bea1efd673b6d48c3a006ce4ac1fd5a5/src/smclarify/util/__init__.py
 # Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# CHANGED BY ME: reimplemented with np.unique/np.bincount instead of pyfunctional, same results
 
 
-def pdf(xs) -> dict:
+def pdf_from_counts(counts) -> np.ndarray:
+    """
+    Normalize frequency counts to probabilities along the last axis
+    :param counts: array of counts, any leading axes are treated as a batch
+    :return: array of the same shape, rows without counts stay all zeros
+    """
+    counts = np.asarray(counts)
+    totals = counts.sum(axis=-1, keepdims=True)
+    return np.divide(counts, totals, out=np.zeros(counts.shape), where=totals != 0)
+
+
+def pdf(xs) -> list:
     """
     Probability distribution function
     :param xs: input sequence
     :return: sequence of tuples as (value, frequency)
     """
-    counts = seq(xs).map(lambda x: (x, 1)).reduce_by_key(lambda x, y: x + y)
-    total = counts.map(lambda x: x[1]).sum()
-    result_pdf = counts.map(lambda x: (x[0], x[1] / total)).sorted().list()
-    return result_pdf
+    values, counts = np.unique(np.asarray(xs), return_counts=True)
+    return list(zip(values.tolist(), pdf_from_counts(counts).tolist()))
+
+
+def pdfs_aligned(*args) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Compute the pdfs of a batch of discrete sequences over the union of their values in one pass
+    :return: sorted union of values and an array of shape (len(args), values) with the aligned pdfs
+    """
+    arrays = [np.asarray(x) for x in args]
+    keys, inverse = np.unique(np.concatenate(arrays), return_inverse=True)
+    owners = np.repeat(np.arange(len(arrays)), [len(x) for x in arrays])
+    counts = np.bincount(owners * len(keys) + inverse.ravel(), minlength=len(arrays) * len(keys))
+    return keys, pdf_from_counts(counts.reshape(len(arrays), len(keys)))
 
 
 def pdfs_aligned_nonzero(*args) -> List[np.ndarray]:
@@ -24,38 +45,7 @@ def pdfs_aligned_nonzero(*args) -> List[np.ndarray]:
     Convert a list of discrete pdfs / freq counts to aligned numpy arrays of the same size for common non-zero elements
     :return: pair of numpy arrays of the same size with the aligned pdfs
     """
-    num_pdfs = len(args)
-    pdfs = []
-    for x in args:
-        pdfs.append(pdf(x))
-
-    def keys(_xs):
-        return seq(_xs).map(lambda x: x[0])
-
-    # Extract union of keys
-    all_keys = seq(pdfs).flat_map(keys).distinct().sorted()
-
-    # Index all pdfs by value
-    dict_pdfs = seq(pdfs).map(dict).list()
-
-    # ADDED BY ME: if key is not in the dict_pdfs, it should be with 0 probability
-    for i in all_keys:
-        for j in dict_pdfs:
-            if i not in j:
-                j[i] = 0.0
-
-    # result aligned lists
-    aligned_lists: List[List] = [[] for x in range(num_pdfs)]
-
-    # fill keys present in all pdfs
+    # ADDED BY ME: if key is not in one of the pdfs, it should be with 0 probability
     # OTHER CHANGE BY ME: if key is not present, it should have 0 probability. KS results would not be precise if not
-    for i, key in enumerate(all_keys):
-        # for j, d in enumerate(dict_pdfs):
-        #     if d.get(key, 0) == 0:
-        #         break
-        # else:
-        # All keys exist and are != 0
-        for j, d in enumerate(dict_pdfs):
-            aligned_lists[j].append(d[key])
-    np_arrays = seq(aligned_lists).map(np.array).list()
-    return np_arrays
+    _, aligned = pdfs_aligned(*args)
+    return list(aligned)
@@ -0,0 +1,135 @@
+# pylint: skip-file
+"""This module contains the vectorized permutation engine used by the permutation tests"""
+import os
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import nullcontext
+from itertools import repeat
+from typing import Tuple
+
+import numpy as np
+
+# repetitions drawn from each independent random stream, also the step of the adaptive tests
+BLOCK_SIZE = 100
+# two sided normal quantile of the confidence interval used to stop adaptive tests (99%)
+STOPPING_Z = 2.576
+
+
+def permuted_counts(counts, n_repetitions, rng) -> np.ndarray:
+    """returns an (n_repetitions, cells, labels) array of contingency tables, distributed as the tables
+    obtained by randomly permuting the labels of the rows behind the (cells, labels) counts table.
+    The labels falling in each cell of a permutation follow a chain of hypergeometric draws, so every
+    repetition is drawn at once for each (cell, label) pair and no rows are materialized"""
+    counts = np.asarray(counts, dtype=np.int64)
+    n_cells, n_labels = counts.shape
+    tables = np.zeros((n_repetitions, n_cells, n_labels), dtype=np.int64)
+    if n_cells == 0 or n_labels == 0:
+        return tables
+    # labels not yet assigned to a cell, per repetition
+    remaining = np.tile(counts.sum(axis=0), (n_repetitions, 1))
+    for cell, cell_size in enumerate(counts.sum(axis=1)[:-1]):
+        sample = np.full(n_repetitions, cell_size, dtype=np.int64)
+        others = remaining.sum(axis=1)
+        for label in range(n_labels - 1):
+            others -= remaining[:, label]
+            tables[:, cell, label] = rng.hypergeometric(remaining[:, label], others, sample)
+            sample -= tables[:, cell, label]
+        tables[:, cell, -1] = sample
+        remaining -= tables[:, cell]
+    tables[:, -1] = remaining
+    return tables
+
+
+def _permutation_block(counts, metric, size, seed_sequence) -> np.ndarray:
+    """evaluates metric on a block of permuted tables drawn from its own random stream"""
+    return np.asarray(metric(permuted_counts(counts, size, np.random.default_rng(seed_sequence))))
+
+
+def permutation_values(counts, metric, n_repetitions, seed=42, n_jobs=1) -> np.ndarray:
+    """returns metric evaluated on n_repetitions permuted tables of the (cells, labels) counts.
+    Repetitions are split in blocks of BLOCK_SIZE, block i always drawing from the i-th stream spawned
+    from SeedSequence(seed), so the values are bit-identical whatever the number of workers.
+    Blocks are spread over n_jobs processes (-1 uses every core), metric must be picklable"""
+    sizes = [min(BLOCK_SIZE, n_repetitions - start) for start in range(0, n_repetitions, BLOCK_SIZE)]
+    streams = np.random.SeedSequence(seed).spawn(len(sizes))
+    n_jobs = os.cpu_count() if n_jobs == -1 else n_jobs
+    if n_jobs == 1 or len(sizes) <= 1:
+        blocks = [_permutation_block(counts, metric, size, stream) for size, stream in zip(sizes, streams)]
+    else:
+        with ProcessPoolExecutor(max_workers=min(n_jobs, len(sizes))) as executor:
+            blocks = list(executor.map(_permutation_block, repeat(counts), repeat(metric), sizes, streams))
+    return np.concatenate(blocks) if blocks else np.array([])
+
+
+def _is_extreme(values, observed) -> np.ndarray:
+    """values at least as extreme (in absolute value) as the observed one"""
+    return (np.abs(values) >= abs(observed)) | np.isclose(np.abs(values), abs(observed))
+
+
+def _significance_is_clear(n_extreme, n_values, alpha) -> bool:
+    """whether the Wilson interval of the p-value (n_extreme + 1) / (n_values + 1) excludes alpha"""
+    n = n_values + 1
+    p = (n_extreme + 1) / n
+    center = (p + STOPPING_Z**2 / (2 * n)) / (1 + STOPPING_Z**2 / n)
+    margin = STOPPING_Z * np.sqrt(p * (1 - p) / n + STOPPING_Z**2 / (4 * n**2)) / (1 + STOPPING_Z**2 / n)
+    return center + margin < alpha or center - margin > alpha
+
+
+def adaptive_permutation_values(counts, metric, max_repetitions, alpha=0.05, seed=42, n_jobs=1) -> np.ndarray:
+    """like permutation_values, but stops after the first block where the confidence interval of the
+    p-value clears alpha, so it returns at most max_repetitions values. Blocks are the same as in
+    permutation_values and the stopping point is checked block by block, so the result is a prefix of
+    the full run and still does not depend on n_jobs"""
+    observed = metric(np.asarray(counts)[np.newaxis])[0]
+    sizes = [min(BLOCK_SIZE, max_repetitions - start) for start in range(0, max_repetitions, BLOCK_SIZE)]
+    streams = np.random.SeedSequence(seed).spawn(len(sizes))
+    n_jobs = os.cpu_count() if n_jobs == -1 else n_jobs
+    blocks, n_extreme, n_values = [], 0, 0
+    with ProcessPoolExecutor(max_workers=n_jobs) if n_jobs > 1 else nullcontext() as executor:
+        for start in range(0, len(sizes), n_jobs):
+            batch = (sizes[start:start + n_jobs], streams[start:start + n_jobs])
+            if executor is None:
+                results = [_permutation_block(counts, metric, size, stream) for size, stream in zip(*batch)]
+            else:
+                results = executor.map(_permutation_block, repeat(counts), repeat(metric), *batch)
+            for values in results:
+                blocks.append(values)
+                n_extreme += int(_is_extreme(values, observed).sum())
+                n_values += len(values)
+                if _significance_is_clear(n_extreme, n_values, alpha):
+                    return np.concatenate(blocks)
+    return np.concatenate(blocks) if blocks else np.array([])
+
+
+def exact_null_distribution(counts, metric) -> Tuple[np.ndarray, np.ndarray]:
+    """returns the distinct values of metric over every table reachable by permuting a binary label
+    over the two cells of the (2 cells, 2 labels) counts table, sorted, with their exact probabilities.
+    The number of label 1 rows falling in cell 0 is hypergeometric, so this is O(rows) and not random"""
+    counts = np.asarray(counts, dtype=np.int64)
+    n_total, n_cell, n_positive = counts.sum(), counts[0].sum(), counts[:, 1].sum()
+    positives = np.arange(max(0, n_positive - (n_total - n_cell)), min(n_positive, n_cell) + 1)
+    # log pmf up to a constant, from the ratio between consecutive hypergeometric probabilities
+    ratios = ((n_positive - positives[:-1]) * (n_cell - positives[:-1])) / \
+             ((positives[:-1] + 1.0) * (n_total - n_positive - n_cell + positives[:-1] + 1))
+    log_pmf = np.concatenate(([0.0], np.cumsum(np.log(ratios))))
+    probabilities = np.exp(log_pmf - log_pmf.max())
+    probabilities /= probabilities.sum()
+    tables = np.empty((len(positives), 2, 2), dtype=np.int64)
+    tables[:, 0, 1] = positives
+    tables[:, 0, 0] = n_cell - positives
+    tables[:, 1, 1] = n_positive - positives
+    tables[:, 1, 0] = n_total - n_cell - tables[:, 1, 1]
+    values, inverse = np.unique(np.asarray(metric(tables)), return_inverse=True)
+    return values, np.bincount(inverse.ravel(), weights=probabilities, minlength=len(values))
+
+
+def exact_quantiles(values, probabilities, n_points) -> np.ndarray:
+    """returns n_points evenly spaced quantiles of an exact distribution, so it can be charted
+    like n_points sorted permutation values"""
+    positions = (np.arange(n_points) + 0.5) / n_points
+    indexes = np.searchsorted(np.cumsum(probabilities), positions)
+    return values[np.minimum(indexes, len(values) - 1)]
+
+
+def p_value(values, probabilities, observed) -> float:
+    """probability of a value at least as extreme (in absolute value) as the observed one"""
+    return float(probabilities[_is_extreme(values, observed)].sum())
@@ -3,7 +3,59 @@
 import pandas as pd
 import numpy as np
 from numpy import Infinity
-from pretrainingbias.clarify_helper import pdfs_aligned_nonzero
+from pretrainingbias.clarify_helper import pdf_from_counts, pdfs_aligned_nonzero
+from pretrainingbias.permutation import (adaptive_permutation_values, exact_null_distribution, exact_quantiles,
+                                         p_value, permutation_values)
+
+
+def _crosstab(codes, shape) -> np.ndarray:
+    """counts every combination of the given integer codes in an array of the given shape"""
+    return np.bincount(np.ravel_multi_index(codes, shape), minlength=int(np.prod(shape))).reshape(shape)
+
+
+class BiasCounts():
+    """sufficient statistics of the pre training bias metrics: counts of every (group, facet, label)
+    combination, facet 0 being the privileged group, plus the size of each facet over all rows"""
+
+    def __init__(self, groups, labels, counts, facet_totals):
+        self.groups = groups
+        self.labels = labels
+        self.counts = counts
+        self.facet_totals = facet_totals
+
+    def facet_label_counts(self) -> np.ndarray:
+        """(facet, label) counts over every group"""
+        return self.counts.sum(axis=0)
+
+    def positive_counts(self, positive_outcome) -> np.ndarray:
+        """(group, facet, label) counts with the label binarized, label 1 being the positive outcome"""
+        positives = self.counts[..., list(self.labels).index(positive_outcome)] \
+            if positive_outcome in list(self.labels) else np.zeros(self.counts.shape[:-1], dtype=np.int64)
+        return np.stack([self.counts.sum(axis=-1) - positives, positives], axis=-1)
+
+    def rollup(self, parent) -> "BiasCounts":
+        """counts of the coarser groups given by parent (group -> parent group), summing the counts of
+        their groups. Groups whose parent is None are dropped"""
+        codes, groups = pd.factorize(pd.Index([parent(group) for group in self.groups], dtype=object), sort=True)
+        counts = np.zeros((len(groups),) + self.counts.shape[1:], dtype=self.counts.dtype)
+        np.add.at(counts, codes[codes >= 0], self.counts[codes >= 0])
+        return BiasCounts(groups, self.labels, counts, self.facet_totals)
+
+
+class TimeCounts():
+    """cumulative counts of every (group, subgroup, facet, label) combination up to each time step,
+    facet 0 being the privileged group. The counts of any window of steps are the difference of two rows"""
+
+    def __init__(self, steps, groups, labels, cumulative):
+        self.steps = steps
+        self.groups = groups
+        self.labels = labels
+        self.cumulative = cumulative
+
+    def window_counts(self, window) -> np.ndarray:
+        """(step, group, subgroup, facet, label) counts of the window of `window` steps ending at each step"""
+        ends = np.arange(1, len(self.steps) + 1)
+        return self.cumulative[ends] - self.cumulative[np.maximum(ends - window, 0)]
 
 
 class PreTrainingBias():
@@ -31,6 +83,58 @@ class PreTrainingBias():
             return Infinity
         return a / b
 
+    def _kl_divergence_from_counts(self, counts) -> np.ndarray:
+        """kl divergence from an array of (..., facet, label) counts, facet 0 being the privileged group"""
+        pdfs = pdf_from_counts(counts)
+        p, q = pdfs[..., 0, :], pdfs[..., 1, :]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            terms = p * np.log(p / q)
+        return np.where(np.isnan(terms), 0.0, terms).sum(axis=-1)
+
+    def _ks_from_counts(self, counts) -> np.ndarray:
+        """ks from an array of (..., facet, label) counts, facet 0 being the privileged group"""
+        pdfs = pdf_from_counts(counts)
+        return np.abs(pdfs[..., 0, :] - pdfs[..., 1, :]).max(axis=-1, initial=0.0)
+
+    def _dpl_from_counts(self, counts) -> np.ndarray:
+        """difference in positive proportions of labels from an array of (..., facet, label) counts,
+        facet 0 being the privileged group and label 1 the positive outcome"""
+        q = pdf_from_counts(counts)[..., 1]
+        return self._difference_in_positive_proportions_of_labels(q[..., 0], q[..., 1])
+
+    def bias_counts(self, df, target, protected_attribute, privileged_group, group_variable=None,
+                    positive_outcome=None) -> "BiasCounts":
+        """returns the (group, facet, label) counts of df, built in a single pass. Every metric can be
+        derived from them, so they can be built once and passed to global_evaluation and reused.
+        Without group_variable every row is in a single group, a list of columns groups by their combinations
+        (the groups being tuples). If positive_outcome is given the target is binarized, label 1 being the
+        positive outcome. Rows with a missing group or target are ignored"""
+        if group_variable is None:
+            group_codes, groups = np.zeros(len(df), dtype=np.intp), pd.Index([None])
+        elif isinstance(group_variable, list):
+            group_codes, groups = pd.MultiIndex.from_frame(df[group_variable]).factorize(sort=True)
+        else:
+            group_codes, groups = pd.factorize(df[group_variable], sort=True)
+        if positive_outcome is None:
+            label_codes, labels = pd.factorize(df[target], sort=True)
+        else:
+            label_codes, labels = (df[target].values == positive_outcome).astype(np.intp), pd.Index([False, True])
+        facet_codes = (df[protected_attribute].values != privileged_group).astype(np.intp)
+        valid = (group_codes >= 0) & (label_codes >= 0)
+        counts = _crosstab((group_codes[valid], facet_codes[valid], label_codes[valid]),
+                           (len(groups), 2, len(labels)))
+        return BiasCounts(groups, labels, counts, np.bincount(facet_codes, minlength=2))
+
+    def metrics_per_group(self, counts) -> pd.DataFrame:
+        """returns the class imbalance between the facets, kl divergence and ks of every group of a
+        BiasCounts, without scanning any data"""
+        facet_sizes = counts.counts.sum(axis=-1)
+        return pd.DataFrame({
+            'CI': self._class_imbalance(facet_sizes.max(axis=-1), facet_sizes.min(axis=-1)),
+            'KL': self._kl_divergence_from_counts(counts.counts),
+            'KS': self._ks_from_counts(counts.counts),
+        }, index=counts.groups)
+
     def class_imbalance(self, df, label, threshold=None):
         """returns the class imbalance for the given label"""
         facet_counts = df[label].value_counts(sort=True)
@@ -74,6 +178,12 @@ class PreTrainingBias():
             ks_val = max(ks_val, abs(np.subtract(j, p_list[1][i])))
         return ks_val
 
+    def dpl(self, df, target, positive_outcome, protected_attribute, privileged_group) -> float:
+        """returns the difference in positive proportions of labels between the privileged group and the others"""
+        counts = self.bias_counts(df, target, protected_attribute, privileged_group,
+                                  positive_outcome=positive_outcome)
+        return float(self._dpl_from_counts(counts.facet_label_counts()))
+
     def cddl(self, df: pd.DataFrame, target: str, positive_outcome, protected_attribute,
                                                 privileged_group, group_variable) -> float:
         """returns the cddl for the given target and protected attribute 
@@ -98,58 +208,169 @@ class PreTrainingBias():
         return self._divide(np.sum(counts * cdd), np.sum(counts))
 
     def global_evaluation(self, df: pd.DataFrame, target: str, positive_outcome, 
-                          protected_attribute, privileged_group, group_variable):
+                          protected_attribute, privileged_group, group_variable, counts=None):
         """returns a dictionary with the metrics for the given target and protected attribute 
-        grouping by the group_variable"""
+        grouping by the group_variable. Every metric comes from a single BiasCounts, which can be
+        passed as counts (built by bias_counts with the same arguments) to skip scanning df"""
+        if counts is None:
+            counts = self.bias_counts(df, target, protected_attribute, privileged_group, group_variable)
+        n_a, n_d = counts.facet_totals
+        facet_label_counts = counts.facet_label_counts()
         dic = {
             f"class imbalance ({protected_attribute})": 
-                self.class_imbalance_per_label(df, protected_attribute, privileged_group),
+                self._class_imbalance(n_a, n_d),
             f"kl divergence ({protected_attribute})": 
-                self.kl_divergence(df, target, protected_attribute, privileged_group),
+                float(self._kl_divergence_from_counts(facet_label_counts)),
             f"ks ({protected_attribute})": 
-                self.ks(df, target, protected_attribute, privileged_group),
+                float(self._ks_from_counts(facet_label_counts)),
             f"cddl ({protected_attribute}, {group_variable})": 
-                self.cddl(df, target, positive_outcome, protected_attribute, 
-                          privileged_group, group_variable)
+                float(self._cddl_from_counts(counts.positive_counts(positive_outcome)))
         }
         return dic
 
+    def time_counts(self, df, target, protected_attribute, privileged_group, time_variable, group_variable,
+                    subgroup_variable=None) -> "TimeCounts":
+        """returns the cumulative (step, group, subgroup, facet, label) counts of df, built in a single pass.
+        Steps are every integer from the first to the last value of time_variable (SEM_PRI, DT_SIN_PRI days),
+        so a window always spans the same number of steps. Without subgroup_variable every row is in a single
+        subgroup. Rows with a missing time, group or target are ignored"""
+        times = pd.to_numeric(df[time_variable]).values
+        has_time = ~np.isnan(times)
+        first = int(times[has_time].min()) if has_time.any() else 0
+        steps = np.arange(first, int(times[has_time].max()) + 1 if has_time.any() else first)
+        time_codes = np.where(has_time, np.nan_to_num(times) - first, -1).astype(np.intp)
+        group_codes, groups = pd.factorize(df[group_variable], sort=True)
+        if subgroup_variable is None:
+            subgroup_codes, n_subgroups = np.zeros(len(df), dtype=np.intp), 1
+        else:
+            subgroup_codes, subgroups = pd.factorize(df[subgroup_variable], sort=True)
+            n_subgroups = len(subgroups)
+        label_codes, labels = pd.factorize(df[target], sort=True)
+        facet_codes = (df[protected_attribute].values != privileged_group).astype(np.intp)
+        valid = (time_codes >= 0) & (group_codes >= 0) & (subgroup_codes >= 0) & (label_codes >= 0)
+        shape = (len(steps), len(groups), n_subgroups, 2, len(labels))
+        counts = _crosstab((time_codes[valid], group_codes[valid], subgroup_codes[valid], facet_codes[valid],
+                            label_codes[valid]), shape)
+        cumulative = np.concatenate([np.zeros((1,) + shape[1:], dtype=counts.dtype), counts.cumsum(axis=0)])
+        return TimeCounts(steps, groups, labels, cumulative)
+
+    def rolling_evaluation(self, df: pd.DataFrame, target: str, positive_outcome, protected_attribute,
+                           privileged_group, time_variable, group_variable, window=1, subgroup_variable=None,
+                           counts=None) -> pd.DataFrame:
+        """returns a tidy dataframe (time_variable, group_variable, 'metric', 'value') with the class imbalance,
+        kl divergence and ks of every group over the window of `window` steps ending at each step, plus the
+        cddl grouping by subgroup_variable when it is given. Windows are differences of the cumulative
+        TimeCounts, which can be passed as counts (built by time_counts with the same arguments) to skip
+        scanning df. Windows without rows are left out"""
+        if counts is None:
+            counts = self.time_counts(df, target, protected_attribute, privileged_group, time_variable,
+                                      group_variable, subgroup_variable)
+        windows = counts.window_counts(window)
+        facet_label_counts = windows.sum(axis=2)
+        facet_totals = facet_label_counts.sum(axis=-1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            metrics = {
+                'class imbalance': self._class_imbalance(facet_totals[..., 0], facet_totals[..., 1]),
+                'kl divergence': self._kl_divergence_from_counts(facet_label_counts),
+                'ks': self._ks_from_counts(facet_label_counts),
+            }
+        if subgroup_variable is not None:
+            positive_counts = BiasCounts(counts.groups, counts.labels, windows, None).positive_counts(positive_outcome)
+            metrics['cddl'] = self._cddl_from_counts(positive_counts)
+        has_rows = facet_totals.sum(axis=-1) > 0
+        step_index, group_index = np.nonzero(has_rows)
+        return pd.concat([pd.DataFrame({time_variable: counts.steps[step_index],
+                                        group_variable: np.asarray(counts.groups)[group_index],
+                                        'metric': metric,
+                                        'value': values[has_rows]})
+                          for metric, values in metrics.items()], ignore_index=True)
+
+    def _cddl_from_counts(self, counts) -> np.ndarray:
+        """cddl from an array of (..., group, facet, label) counts, facet 1 being the disadvantaged group
+        and label 1 the positive outcome"""
+        group_counts = counts.sum(axis=(-2, -1))
+        label_totals = counts.sum(axis=-2)
+        disadvantaged = counts[..., 1, :]
+        proportions = np.divide(disadvantaged, label_totals, out=np.zeros(disadvantaged.shape),
+                                where=label_totals != 0)
+        cdd = proportions[..., 0] - proportions[..., 1]
+        total = group_counts.sum(axis=-1)
+        return np.divide((group_counts * cdd).sum(axis=-1), total, out=np.zeros(total.shape), where=total != 0)
+
+    def _binary_counts(self, df, target, protected_attribute, privileged_group, positive_outcome=None):
+        """returns the (facet, label) counts of a binary target, as needed by the exact null distribution"""
+        counts = self.bias_counts(df, target, protected_attribute, privileged_group,
+                                  positive_outcome=positive_outcome).facet_label_counts()
+        if counts.shape[-1] > 2:
+            raise ValueError("exact null distribution needs a binary target")
+        return np.pad(counts, ((0, 0), (0, 2 - counts.shape[-1])))
+
+    def _null_values(self, counts, metric, n_repetitions, seed, n_jobs, method, alpha=0.05) -> np.ndarray:
+        """values of metric under the null hypothesis. method is 'permutation' (n_repetitions sampled
+        permutations), 'adaptive' (permutations until the p-value is clearly above or below alpha, at most
+        n_repetitions, the number used is the length of the result) or 'exact' (evenly spaced quantiles of
+        the exact distribution of a binary target)"""
+        if method == 'exact':
+            return exact_quantiles(*exact_null_distribution(counts, metric), n_repetitions)
+        if method == 'adaptive':
+            return adaptive_permutation_values(counts, metric, n_repetitions, alpha, seed, n_jobs)
+        if method == 'permutation':
+            return permutation_values(counts, metric, n_repetitions, seed, n_jobs)
+        raise ValueError(f"unknown method {method}")
+
+    def get_exact_null_distribution(self, df, target, protected_attribute, privileged_group, metric='ks',
+                                    positive_outcome=None):
+        """returns the exact null distribution ('value' and 'probability' columns) of the ks, kl or dpl
+        metric for a binary target, and the p-value of the observed metric. dpl needs positive_outcome"""
+        metrics = {'ks': self._ks_from_counts, 'kl': self._kl_divergence_from_counts, 'dpl': self._dpl_from_counts}
+        counts = self._binary_counts(df, target, protected_attribute, privileged_group, positive_outcome)
+        values, probabilities = exact_null_distribution(counts, metrics[metric])
+        observed = metrics[metric](counts)
+        return pd.DataFrame({'value': values, 'probability': probabilities}), p_value(values, probabilities, observed)
+
     def get_class_imbalance_permutation_values(self, df, label, n_repetitions, threshold=None):
-        np.random.seed(42)
         original_class_imbalance = self.class_imbalance(df, label, threshold)
-        class_imbalance_permutation_values = []
-        for i in range(n_repetitions):
-            df_permuted = df.copy()
-            df_permuted[label] = np.random.permutation(df[label])
-            class_imbalance_permutation_values.append(self.class_imbalance(df_permuted, label, threshold))
-        return class_imbalance_permutation_values, original_class_imbalance
-
-    def get_ks_permutation_values(self, df, target, protected_attribute, privileged_group, n_repetitions):
-        np.random.seed(42)
+        # permuting the label keeps its value counts, so every permutation has the same class imbalance
+        return [original_class_imbalance] * n_repetitions, original_class_imbalance
+
+    def _cddl_from_cell_counts(self, counts) -> np.ndarray:
+        """cddl from an array of (..., group * 2 + facet, label) counts, as used by the permutation engine"""
+        return self._cddl_from_counts(counts.reshape(counts.shape[:-2] + (-1, 2, counts.shape[-1])))
+
+    def get_ks_permutation_values(self, df, target, protected_attribute, privileged_group, n_repetitions, seed=42, n_jobs=1,
+                                  method='permutation', alpha=0.05):
         original_ks = self.ks(df, target, protected_attribute, privileged_group)
-        ks_permutation_values = []
-        for i in range(n_repetitions):
-            df_permuted = df.copy()
-            df_permuted[target] = np.random.permutation(df[target])
-            ks_permutation_values.append(self.ks(df_permuted, target, protected_attribute, privileged_group))
-        return ks_permutation_values, original_ks
-
-    def get_cddl_permutation_values(self, df, target, positive_outcome, protected_attribute, privileged_group, group_variable, n_repetitions):
-        np.random.seed(42)
+        if method == 'exact':
+            counts = self._binary_counts(df, target, protected_attribute, privileged_group)
+        else:
+            counts = self.bias_counts(df, target, protected_attribute, privileged_group).facet_label_counts()
+        values = self._null_values(counts, self._ks_from_counts, n_repetitions, seed, n_jobs, method, alpha)
+        return values.tolist(), original_ks
+
+    def get_cddl_permutation_values(self, df, target, positive_outcome, protected_attribute, privileged_group, group_variable, n_repetitions, seed=42, n_jobs=1,
+                                    method='permutation', alpha=0.05):
         original_cddl = self.cddl(df, target, positive_outcome, protected_attribute, privileged_group, group_variable)
-        cddl_permutation_values = []
-        for i in range(n_repetitions):
-            df_permuted = df.copy()
-            df_permuted[target] = np.random.permutation(df[target])
-            cddl_permutation_values.append(self.cddl(df_permuted, target, positive_outcome, protected_attribute, privileged_group, group_variable))
-        return cddl_permutation_values, original_cddl
-
-    def get_kl_divergence_permutation_values(self, df, target, protected_attribute, privileged_group, n_repetitions):
-        np.random.seed(42)
+        counts = self.bias_counts(df, target, protected_attribute, privileged_group, group_variable,
+                                  positive_outcome).counts
+        if method == 'exact':
+            raise ValueError("cddl has no exact null distribution")
+        values = self._null_values(counts.reshape(-1, 2), self._cddl_from_cell_counts, n_repetitions, seed, n_jobs,
+                                   method, alpha)
+        return values.tolist(), original_cddl
+
+    def get_kl_divergence_permutation_values(self, df, target, protected_attribute, privileged_group, n_repetitions, seed=42, n_jobs=1,
+                                             method='permutation', alpha=0.05):
         original_kl_divergence = self.kl_divergence(df, target, protected_attribute, privileged_group)
-        kl_divergence_permutation_values = []
-        for i in range(n_repetitions):
-            df_permuted = df.copy()
-            df_permuted[target] = np.random.permutation(df[target])
-            kl_divergence_permutation_values.append(self.kl_divergence(df_permuted, target, protected_attribute, privileged_group))
-        return kl_divergence_permutation_values, original_kl_divergence
+        if method == 'exact':
+            counts = self._binary_counts(df, target, protected_attribute, privileged_group)
+        else:
+            counts = self.bias_counts(df, target, protected_attribute, privileged_group).facet_label_counts()
+        values = self._null_values(counts, self._kl_divergence_from_counts, n_repetitions, seed, n_jobs, method, alpha)
+        return values.tolist(), original_kl_divergence
+
+    def get_dpl_permutation_values(self, df, target, positive_outcome, protected_attribute, privileged_group, n_repetitions,
+                                   seed=42, n_jobs=1, method='permutation', alpha=0.05):
+        original_dpl = self.dpl(df, target, positive_outcome, protected_attribute, privileged_group)
+        counts = self._binary_counts(df, target, protected_attribute, privileged_group, positive_outcome)
+        values = self._null_values(counts, self._dpl_from_counts, n_repetitions, seed, n_jobs, method, alpha)
+        return values.tolist(), original_dpl
@@ -1,10 +1,32 @@
 """main streamlit app file"""
 import altair as alt
+import numpy as np
 import pandas as pd
 import streamlit as st
 
 from pretrainingbias.pre_training_bias import PreTrainingBias
 
+NULL_METHODS = {"Permutations": "permutation",
+                "Permutations, stop when significance is clear": "adaptive",
+                "Exact (binary target)": "exact"}
+
+@st.cache_data
+def facet_mask(dataset, _df, col, feat_type, selection) -> np.ndarray:
+    """ Boolean mask of the privileged rows of col, cached by (dataset, col, selection).
+    The dataframe is not hashed, dataset identifies it"""
+    if feat_type == 'Numerical':
+        return _df[col].between(*selection).values
+    if feat_type == 'Binary':
+        return (_df[col] == selection).values
+    return _df[col].isin(selection).values
+
+def facet_frame(dataset, df, facet, *columns) -> pd.DataFrame:
+    """ Returns columns of df plus the facet column (True for the privileged rows),
+    without adding it to the session dataframe"""
+    if facet is None:
+        raise KeyError("the feature is not configured")
+    facet_col, col, feat_type, selection = facet
+    return df[list(dict.fromkeys(columns))].assign(**{facet_col: facet_mask(dataset, df, col, feat_type, selection)})
 
 def show_feature_config():
     """show feature configuration"""
@@ -18,8 +40,7 @@ def show_feature_config():
         try:
             values = st.slider('Select the privileged class',
                                 df[col].min(), df[col].max(), (df[col].min(), df[col].max()))
-            df[f"{col}_privileged"] = df[col].apply(
-                lambda x: "Privileged" if values[0] <= x <= values[1] else "Unprivileged")
+            st.session_state['facet'] = (f"{col}_privileged", col, feat_type, tuple(values))
             st.session_state['new_col'] = f"{col}_privileged"
         except KeyError:
             st.error(
@@ -31,16 +52,14 @@ def show_feature_config():
                 f"{col} is not a binary feature. Please select another feature type or feature.")
         else:
             value = st.radio('Select the privileged class', df[col].unique())
-            df[f"{col}_privileged"] = df[col].apply(
-                lambda x: "Privileged" if value == x else "Unprivileged")
+            st.session_state['facet'] = (f"{col}_privileged", col, feat_type, value)
             st.session_state['new_col'] = f"{col}_privileged"
 
     elif feat_type == 'Categorical':
         values = st.multiselect(
             'Select the privileged classes', df[col].unique())
 
-        df[f"{col}_privileged"] = df[col].apply(
-            lambda x: "Privileged" if x in values else "Unprivileged")
+        st.session_state['facet'] = (f"{col}_privileged", col, feat_type, tuple(values))
 
         st.session_state['new_col'] = f"{col}_privileged"
 
@@ -60,7 +79,8 @@ def compute_metrics():
     """
     _ptb = PreTrainingBias()
     df = st.session_state['df']
-    col = st.session_state['new_col']
+    dataset = st.session_state['dataset']
+    facet = st.session_state['facet']
     metrics = st.session_state['metrics']
     target = st.session_state['target']
     positive_outcome = st.session_state['positive_outcome']
@@ -68,7 +88,7 @@ def compute_metrics():
     if 'Class Imbalance' in metrics:
         st.markdown("### Class Imbalance")
         try:
-            show_class_imbalance(_ptb, df, col)
+            show_class_imbalance(_ptb, df, dataset, facet)
         except ValueError:
             st.error(
                 "Invalid value for class imbalance. Check feature configuration")
@@ -79,8 +99,9 @@ def compute_metrics():
     if 'KL Divergence' in metrics:
         st.markdown("### KL Divergence")
         permutations_kl = st.number_input("Num permutations", 0, 10000, key="permutations_kl")
+        method_kl = NULL_METHODS[st.radio("Null distribution", list(NULL_METHODS), key="method_kl")]
         try:
-            show_kl_divergence(_ptb, df, col, target, permutations_kl)
+            show_kl_divergence(_ptb, df, dataset, facet, target, permutations_kl, method_kl)
         except ValueError:
             st.error(
                 "Invalid value for KL Divergence. Check feature configuration")
@@ -91,8 +112,9 @@ def compute_metrics():
     if 'KS' in metrics:
         st.markdown("### KS")
         permutations_ks = st.number_input("Num permutations", 0, 10000, key="permutations_ks")
+        method_ks = NULL_METHODS[st.radio("Null distribution", list(NULL_METHODS), key="method_ks")]
         try:
-            show_ks(_ptb, df, col, target, permutations_ks)
+            show_ks(_ptb, df, dataset, facet, target, permutations_ks, method_ks)
         except ValueError:
             st.error("Invalid value for KS. Check feature configuration")
         except KeyError:
@@ -101,9 +123,10 @@ def compute_metrics():
     if 'CDDL' in metrics:
         group_variable = st.session_state['group_variable']
         permutations_cddl = st.number_input("Num permutations", 0, 10000, key="permutations_cddl")
+        method_cddl = NULL_METHODS[st.radio("Null distribution", list(NULL_METHODS)[:2], key="method_cddl")]
         st.markdown("### CDDL")
         try:
-            show_cddl(_ptb, df, col, target, positive_outcome, group_variable, permutations_cddl)
+            show_cddl(_ptb, df, dataset, facet, target, positive_outcome, group_variable, permutations_cddl, method_cddl)
         except ValueError:
             st.error("Invalid value for CDDL. Check feature configuration")
         except KeyError:
@@ -111,16 +134,22 @@ def compute_metrics():
                 "Invalid value for class imbalance. Check feature configuration")
 
 @st.cache_data
-def show_cddl(_ptb, df, col, target, positive_outcome, group_variable, permutation_cddl):
+def show_cddl(_ptb, _df, dataset, facet, target, positive_outcome, group_variable, permutation_cddl,
+              method="permutation"):
     """ Compute and show CDDL chart """
-    permutations_cddl, original_cddl = _ptb.get_cddl_permutation_values(df,
+    permutations_cddl, original_cddl = _ptb.get_cddl_permutation_values(facet_frame(dataset, _df, facet, target,
+                                                                                    group_variable),
                                                                         target,
                                                                         positive_outcome,
-                                                                        col,
-                                                                        "Privileged",
+                                                                        facet[0],
+                                                                        True,
                                                                         group_variable,
-                                                                        permutation_cddl)
+                                                                        permutation_cddl,
+                                                                        n_jobs=-1,
+                                                                        method=method)
     df_permutations_cddl = pd.DataFrame(permutations_cddl, columns=['CDDL'])
+    if method == "adaptive":
+        st.caption(f"Stopped after {len(permutations_cddl)} permutations")
     df_permutations_cddl = df_permutations_cddl.sort_values('CDDL').reset_index(drop=True)
     df_permutations_cddl['index'] = df_permutations_cddl.index
 
@@ -134,10 +163,14 @@ def show_cddl(_ptb, df, col, target, positive_outcome, group_variable, permutati
     st.altair_chart(c + original_cddl_line, use_container_width=True)
 
 @st.cache_data
-def show_ks(_ptb, df, col, target, permutations_ks):
+def show_ks(_ptb, _df, dataset, facet, target, permutations_ks, method="permutation"):
     """ Compute and show KS chart """
-    permutations_ks, original_ks = _ptb.get_ks_permutation_values(df, target, col, "Privileged", permutations_ks)
+    permutations_ks, original_ks = _ptb.get_ks_permutation_values(facet_frame(dataset, _df, facet, target), target,
+                                                                  facet[0], True, permutations_ks, n_jobs=-1,
+                                                                  method=method)
     df_permutations_ks = pd.DataFrame(permutations_ks, columns=['ks'])
+    if method == "adaptive":
+        st.caption(f"Stopped after {len(permutations_ks)} permutations")
     df_permutations_ks = df_permutations_ks.sort_values('ks').reset_index(drop=True)
     df_permutations_ks['index'] = df_permutations_ks.index
     c = alt.Chart(df_permutations_ks).mark_area(
@@ -152,10 +185,14 @@ def show_ks(_ptb, df, col, target, permutations_ks):
     st.altair_chart(c + original_ks_line, use_container_width=True)
 
 @st.cache_data
-def show_kl_divergence(_ptb, df, col, target, permutations_kl):
+def show_kl_divergence(_ptb, _df, dataset, facet, target, permutations_kl, method="permutation"):
     """ Compute and show KL divergence chart """
-    permutations_kl, original_kl = _ptb.get_kl_divergence_permutation_values(df, target, col, "Privileged", permutations_kl)
+    permutations_kl, original_kl = _ptb.get_kl_divergence_permutation_values(facet_frame(dataset, _df, facet, target), target,
+                                                                             facet[0], True, permutations_kl, n_jobs=-1,
+                                                                             method=method)
     df_permutations_kl = pd.DataFrame(permutations_kl, columns=['kl'])
+    if method == "adaptive":
+        st.caption(f"Stopped after {len(permutations_kl)} permutations")
     df_permutations_kl = df_permutations_kl.sort_values('kl').reset_index(drop=True)
     df_permutations_kl['index'] = df_permutations_kl.index
     c = alt.Chart(df_permutations_kl).mark_area(
@@ -170,9 +207,10 @@ def show_kl_divergence(_ptb, df, col, target, permutations_kl):
     st.altair_chart(c + original_kl_line, use_container_width=True)
 
 @st.cache_data
-def show_class_imbalance(_ptb, df, col):
+def show_class_imbalance(_ptb, _df, dataset, facet):
     """ Compute and show class imbalance chart """
-    permutations, _ = _ptb.get_class_imbalance_permutation_values(df=df, label=col, n_repetitions=1000)
+    permutations, _ = _ptb.get_class_imbalance_permutation_values(df=facet_frame(dataset, _df, facet), label=facet[0],
+                                                                  n_repetitions=1000)
     df_permutations = pd.DataFrame(permutations, columns=['ci'])
     df_permutations = df_permutations.sort_values('ci').reset_index(drop=True)
     df_permutations['index'] = df_permutations.index
@@ -192,13 +230,17 @@ def show_distribution_charts():
     df = st.session_state['df']
     col = st.session_state['col']
     new_col = st.session_state['new_col']
+    target = st.session_state['target']
     if st.checkbox("Show class distribution", value=False):
         if new_col:
             st.markdown("### Class distribution")
+            counts = facet_frame(st.session_state['dataset'], df, st.session_state['facet'], target) \
+                .value_counts([new_col, target]).reset_index(name='count')
+            counts[new_col] = np.where(counts[new_col], "Privileged", "Unprivileged")
             c = (
-                alt.Chart(df)
+                alt.Chart(counts)
                 .mark_bar()
-                .encode(alt.X(new_col, title=""), alt.Y("count()", title="Count"), color=f"{st.session_state['target']}:N")
+                .encode(alt.X(new_col, title=""), alt.Y("count:Q", title="Count"), color=f"{target}:N")
             )
             st.altair_chart(c, use_container_width=True)
 
@@ -246,6 +288,10 @@ def get_input_data(file, advanced_settings):
             st.markdown("### Sample from Input Data")
             st.write(df[:10])
         st.session_state['df'] = df
+        # identifies the uploaded frame in the facet mask cache, instead of hashing it
+        st.session_state['dataset'] = (input_data.file_id, st.session_state['col_sep'], st.session_state['dec_sep'],
+                                       st.session_state['encoding'], st.session_state['header_row'],
+                                       st.session_state['names'])
 
 @st.cache_data
 def read_file(input_data, sep, dec, encoding, header_row, names):
@@ -262,6 +308,7 @@ def main():
 
     st.markdown("# Bias comparison on uploaded dataset")
     st.session_state['new_col'] = ""
+    st.session_state['facet'] = None
 
     with st.sidebar:
         st.file_uploader(label="Upload a CSV file to use as input data", type={"csv"}, key="file")
@@ -0,0 +1,84 @@
+"""Equivalence tests of the NumPy pdf helpers against the previous pyfunctional implementation"""
+import math
+
+import numpy as np
+import pytest
+
+from pretrainingbias.clarify_helper import pdf, pdfs_aligned_nonzero
+
+
+def old_pdf(xs) -> list:
+    """pdf as implemented with pyfunctional: reduce_by_key accumulates into a dict, then sorted"""
+    counts = {}
+    for x in xs:
+        counts[x] = counts.get(x, 0) + 1
+    total = sum(counts.values())
+    return sorted((key, count / total) for key, count in counts.items())
+
+
+def old_pdfs_aligned_nonzero(*args, with_keys=False):
+    """pdfs_aligned_nonzero as implemented with pyfunctional: distinct goes through a set.
+    with_keys also returns the keys of the columns, their order is arbitrary around NaN"""
+    pdfs = [old_pdf(x) for x in args]
+    all_keys = sorted(set(key for result_pdf in pdfs for key, _ in result_pdf))
+    dict_pdfs = [dict(result_pdf) for result_pdf in pdfs]
+    for key in all_keys:
+        for dict_pdf in dict_pdfs:
+            if key not in dict_pdf:
+                dict_pdf[key] = 0.0
+    arrays = [np.array([dict_pdf[key] for key in all_keys]) for dict_pdf in dict_pdfs]
+    return (all_keys, arrays) if with_keys else arrays
+
+
+INPUTS = {
+    'int': (np.array([3, 1, 2, 3, 3, 1]), np.array([1, 1, 4, 2])),
+    'int list': ([0, 1, 1, 1], [1, 0, 0]),
+    'float': (np.array([0.5, 1.25, 0.5, 2.0]), np.array([2.0, 3.5])),
+    'bool': (np.array([True, False, True, True]), np.array([False, False])),
+    'str': (np.array(['b', 'a', 'b', 'c']), np.array(['a', 'd'])),
+    'empty': (np.array([]), np.array([1.0, 2.0])),
+    'both empty': (np.array([]), np.array([])),
+}
+
+
+@pytest.mark.parametrize('name', INPUTS)
+def test_pdf_matches_previous_implementation(name):
+    for xs in INPUTS[name]:
+        new, old = pdf(xs), old_pdf(xs)
+        assert [key for key, _ in new] == [key for key, _ in old]
+        np.testing.assert_allclose([value for _, value in new], [value for _, value in old])
+
+
+@pytest.mark.parametrize('name', INPUTS)
+def test_pdfs_aligned_nonzero_matches_previous_implementation(name):
+    new, old = pdfs_aligned_nonzero(*INPUTS[name]), old_pdfs_aligned_nonzero(*INPUTS[name])
+    assert len(new) == len(old)
+    for new_array, old_array in zip(new, old):
+        np.testing.assert_allclose(new_array, old_array)
+
+
+def test_pdf_merges_nan():
+    # the previous version kept every NaN read from an array as its own key, np.unique merges them
+    xs = np.array([1.0, np.nan, 2.0, np.nan])
+    old = old_pdf(xs)
+    assert len([key for key, _ in old if math.isnan(key)]) == 2
+    assert [value for key, value in old if math.isnan(key)] == [0.25, 0.25]
+
+    new = pdf(xs)
+    assert [key for key, _ in new[:2]] == [1.0, 2.0]
+    assert [value for _, value in new[:2]] == [0.25, 0.25]
+    assert math.isnan(new[2][0]) and new[2][1] == 0.5
+    assert len(new) == 3
+
+
+def test_pdfs_aligned_nonzero_merges_nan():
+    # keys other than NaN are aligned as before, the NaN column holds the sum of the previous NaN columns
+    xs, ys = np.array([1.0, np.nan, 2.0, np.nan]), np.array([np.nan, 2.0, 3.0])
+    old_keys, old = old_pdfs_aligned_nonzero(xs, ys, with_keys=True)
+    old, new = np.array(old), np.array(pdfs_aligned_nonzero(xs, ys))
+    old_nan = np.array([math.isnan(key) for key in old_keys])
+
+    assert old.shape == (2, 6) and new.shape == (2, 4)
+    for position, key in enumerate([1.0, 2.0, 3.0]):
+        np.testing.assert_allclose(new[:, position], old[:, old_keys.index(key)])
+    np.testing.assert_allclose(new[:, 3], old[:, old_nan].sum(axis=1))